@@ -0,0 +1,84 @@
+import asyncio
+import logging
+
+logger = logging.getLogger("colabrtc.adaptation")
+
+
+def _fraction_lost(stats):
+    # aiortc reports the raw RTCP field: the lost fraction in 1/256ths
+    return (stats.fractionLost or 0) / 256
+
+
+class CongestionController:
+    """
+    Adapts the output resolution and frame rate of a `VideoTransformTrack`
+    to the link, using the RTCP receiver reports exposed by
+    `RTCPeerConnection.getStats()` (loss and round-trip time). Frames are
+    downscaled (and dropped) before they reach the encoder, which saves
+    encoder CPU and keeps latency down when the network cannot carry them.
+    """
+
+    # (output scale, max frame rate), from best to most degraded
+    LEVELS = [(1., None), (.75, 30), (.5, 20), (.5, 15), (.35, 10)]
+
+    def __init__(self, pc, track, interval=1., max_loss=.05, max_rtt=.3,
+                 recover_after=5, levels=None):
+        self.pc = pc
+        self.track = track
+        self.interval = interval
+        self.max_loss = max_loss
+        self.max_rtt = max_rtt
+        self.recover_after = recover_after
+        self.levels = levels or CongestionController.LEVELS
+        self.level = 0
+        self.loss = None
+        self.rtt = None
+        self._good_samples = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while self.pc.signalingState != 'closed':
+            await asyncio.sleep(self.interval)
+            try:
+                self.update(await self.pc.getStats())
+            except Exception as err:
+                logger.debug(f'Could not update congestion state: {err}')
+
+    def update(self, report):
+        reports = [stats for stats in report.values()
+                   if stats.type == 'remote-inbound-rtp' and stats.kind == 'video']
+        if not reports:
+            return
+
+        self.loss = max(_fraction_lost(stats) for stats in reports)
+        self.rtt = max(stats.roundTripTime or 0 for stats in reports)
+
+        if self.loss > self.max_loss or self.rtt > self.max_rtt:
+            self._good_samples = 0
+            self._set_level(self.level + 1)
+        elif self.loss < self.max_loss / 4 and self.rtt < self.max_rtt / 2:
+            self._good_samples += 1
+            if self._good_samples >= self.recover_after:
+                self._good_samples = 0
+                self._set_level(self.level - 1)
+
+    def _set_level(self, level):
+        level = min(max(level, 0), len(self.levels) - 1)
+        if level != self.level:
+            self.level = level
+            scale, max_fps = self.levels[level]
+            logger.info(f'Output level {level}: scale {scale}, max fps {max_fps} '
+                        f'(loss {self.loss:.3f}, rtt {self.rtt:.3f}s)')
+        scale, max_fps = self.levels[self.level]
+        self.track.output_scale = scale
+        self.track.max_fps = max_fps
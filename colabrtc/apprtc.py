@@ -0,0 +1,163 @@
+import json
+import logging
+import time
+import asyncio
+
+from aiortc.contrib.signaling import ApprtcSignaling
+
+from signaling import (BYE, POLL_TIMEOUT, POLL_INTERVAL, object_from_string,
+                       object_to_string, register_callbacks, to_javascript)
+
+try:
+    import aiohttp
+    import websockets
+except ImportError:  # pragma: no cover
+    aiohttp = None
+    websockets = None
+
+logger = logging.getLogger("colabrtc.signaling")
+
+
+class ColabApprtcSignaling(ApprtcSignaling):
+    def __init__(self, room=None, javacript_callable=False):
+        super().__init__(room)
+
+        self._javascript_callable = javacript_callable
+
+        if javacript_callable:
+            register_callbacks(self, room)
+            
+    @property
+    def room(self):
+        return self._room
+
+    async def connect(self):
+        join_url = self._origin + "/join/" + self._room
+
+        # fetch room parameters
+        self._http = aiohttp.ClientSession()
+        async with self._http.post(join_url) as response:
+            # we cannot use response.json() due to:
+            # https://github.com/webrtc/apprtc/issues/562
+            data = json.loads(await response.text())
+        assert data["result"] == "SUCCESS"
+        params = data["params"]
+
+        self.__is_initiator = params["is_initiator"] == "true"
+        self.__messages = params["messages"]
+        self.__post_url = (
+            self._origin + "/message/" + self._room + "/" + params["client_id"]
+        )
+
+        # connect to websocket
+        self._websocket = await websockets.connect(
+            params["wss_url"], extra_headers={"Origin": self._origin}
+        )
+        await self._websocket.send(
+            json.dumps(
+                {
+                    "clientid": params["client_id"],
+                    "cmd": "register",
+                    "roomid": params["room_id"],
+                }
+            )
+        )
+
+        print(f"AppRTC room is {params['room_id']} {params['room_link']}")
+
+        return params
+            
+    def connect_sync(self):
+        loop = asyncio.get_event_loop()
+        result = loop.run_until_complete(self.connect())
+        if self._javascript_callable:
+            return to_javascript(result)
+        return result
+            
+    async def close(self):
+        # Overridden so BYE is the colabrtc sentinel, not aiortc's
+        if self._websocket:
+            await self.send(BYE)
+            await self._websocket.close()
+        if self._http:
+            await self._http.close()
+
+    def close_sync(self):
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self.close())
+    
+    def recv_nowait(self):
+        try:
+            return self._websocket.messages.popleft() # .get_nowait()
+        #except (asyncio.queues.QueueEmpty, IndexError):
+        except IndexError:
+            pass
+        
+    async def receive(self):
+        if self.__messages:
+            message = self.__messages.pop(0)
+        else:
+            message = self.recv_nowait()
+            if message:
+                message = json.loads(message)["msg"]
+        
+        if message:
+            logger.debug("< " + message)
+            return object_from_string(message)
+    
+    def receive_sync(self):
+        loop = asyncio.get_event_loop()
+        message = loop.run_until_complete(self.receive())
+        if message and self._javascript_callable:
+            message = object_to_string(message)
+            print('receive:', message)
+            message = json.loads(message)
+            message = to_javascript(message)
+        return message
+    
+    async def receive_batch(self, timeout=POLL_TIMEOUT, max_messages=None):
+        deadline = time.monotonic() + timeout
+        messages = []
+        while True:
+            message = await self.receive()
+            while message:
+                messages.append(message)
+                if max_messages and len(messages) >= max_messages:
+                    return messages
+                message = await self.receive()
+            if messages or time.monotonic() >= deadline:
+                return messages
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def receive_batch_sync(self, timeout=0, max_messages=None):
+        loop = asyncio.get_event_loop()
+        messages = loop.run_until_complete(self.receive_batch(timeout, max_messages))
+        if self._javascript_callable:
+            messages = [json.loads(object_to_string(m)) for m in messages]
+            return to_javascript(messages)
+        return messages
+
+    async def send(self, obj):
+        message = object_to_string(obj)
+        logger.debug("> " + message)
+        if self.__is_initiator:
+            await self._http.post(self.__post_url, data=message)
+        else:
+            await self._websocket.send(json.dumps({"cmd": "send", "msg": message}))
+        
+    def send_sync(self, message):
+        print('send:', message)
+        if type(message) == str:
+            message_json = json.loads(message)
+            if 'candidate' in message_json:
+                message_json['type'] = 'candidate'
+                message_json["id"] = message_json["sdpMid"]
+                message_json["label"] = message_json["sdpMLineIndex"]
+                message = json.dumps(message_json)  
+                message = object_from_string(message)
+            elif 'type' in message_json:
+                # offers, answers and candidate batches from Javascript
+                message = object_from_string(message)
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self.send(message))
+    
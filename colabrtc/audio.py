@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import logging
+import time
+
+import numpy as np
+from av import AudioFrame
+from aiortc.mediastreams import AudioStreamTrack, MediaStreamError
+
+logger = logging.getLogger("colabrtc.audio")
+
+# sample formats (packed or planar) passed to transforms: dtype, and the
+# scale of the samples to convert them to [-1, 1]
+SAMPLE_FORMATS = {
+    's16': (np.int16, 32768.),
+    's32': (np.int32, 2147483648.),
+    'flt': (np.float32, 1.),
+    'dbl': (np.float64, 1.),
+}
+
+
+def frame_to_samples(frame):
+    """Return the samples of an audio frame as float32 (channels, samples)."""
+    samples = frame.to_ndarray()
+    if not frame.format.is_planar:
+        # packed: one row of interleaved channels
+        samples = samples.reshape(-1, len(frame.layout.channels)).T
+    _, scale = SAMPLE_FORMATS[frame.format.name.rstrip('p')]
+    samples = samples.astype(np.float32)
+    if scale != 1.:
+        samples /= scale
+    return samples
+
+
+def samples_to_frame(samples, like):
+    """Build an audio frame from float32 (channels, samples), in the format of `like`."""
+    dtype, scale = SAMPLE_FORMATS[like.format.name.rstrip('p')]
+    if scale != 1.:
+        samples = np.clip(samples * scale, -scale, scale - 1)
+    samples = samples.astype(dtype)
+    if not like.format.is_planar:
+        samples = samples.T.reshape(1, -1)
+    frame = AudioFrame.from_ndarray(np.ascontiguousarray(samples), format=like.format.name,
+                                    layout=like.layout.name)
+    frame.sample_rate = like.sample_rate
+    frame.pts = like.pts
+    frame.time_base = like.time_base
+    return frame
+
+
+class AudioTransformTrack(AudioStreamTrack):
+    """
+    Runs `audio_transformer` on windows of at least `window` seconds of
+    audio rather than on every (usually 20ms) frame: `transform(samples,
+    sample_rate)` gets float32 samples shaped (channels, samples), in
+    [-1, 1], and returns the same shape. The output is split back into the
+    received frames, with their timestamps.
+
+    The audio is held for the latency of `video_track` (a
+    `VideoTransformTrack`), so it stays in sync with the transformed video.
+    Without a source track, e.g. while reconnecting, silence is sent.
+    """
+
+    def __init__(self, track, audio_transformer, window=.06, video_track=None):
+        super().__init__()
+        if hasattr(audio_transformer, 'prepare'):
+            audio_transformer.prepare()
+        self.__transform = getattr(audio_transformer, 'transform', audio_transformer)
+        self.track = track
+        self.window = window
+        self.video_track = video_track
+        # (frame, time received) waiting for a full window, then output
+        self._pending = []
+        self._output = collections.deque()
+        self.transform_time = 0.
+        self.windows = 0
+
+    async def recv(self):
+        if self.readyState != 'live':
+            raise MediaStreamError
+
+        while not self._output:
+            frame = await self._next_frame() if self.track else None
+            if frame is None:
+                if self._pending:
+                    self._process()
+                    continue
+                # no remote audio
+                return await super().recv()
+            if frame.format.name.rstrip('p') not in SAMPLE_FORMATS:
+                logger.debug(f'Sample format {frame.format.name} is not transformed')
+                return frame
+
+            self._pending.append((frame, time.monotonic()))
+            if sum(f.samples for f, _ in self._pending) >= self.window * frame.sample_rate:
+                self._process()
+
+        frame, received = self._output.popleft()
+        latency = self.video_track.latency if self.video_track is not None else 0.
+        # batching already delayed the frame, only wait for the rest
+        wait = received + latency - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return frame
+
+    async def _next_frame(self):
+        track = self.track
+        try:
+            return await track.recv()
+        except MediaStreamError:
+            if self.track is track:
+                if self._pending:
+                    # flush the last window first
+                    return None
+                raise
+            # the remote track was replaced while waiting for it
+            return None
+
+    def _process(self):
+        frames = [frame for frame, _ in self._pending]
+        # frames may change format or layout (e.g. a new connection)
+        if any(f.format.name != frames[0].format.name or f.layout.name != frames[0].layout.name or
+               f.sample_rate != frames[0].sample_rate for f in frames):
+            self._output.extend(self._pending)
+            self._pending = []
+            return
+
+        samples = np.concatenate([frame_to_samples(frame) for frame in frames], axis=1)
+        start = time.perf_counter()
+        try:
+            samples = self.__transform(samples, frames[0].sample_rate)
+        except Exception as ex:
+            logger.error(ex)
+            samples = None
+        self.transform_time += time.perf_counter() - start
+        self.windows += 1
+
+        offset = 0
+        for frame, received in self._pending:
+            if samples is not None:
+                frame = samples_to_frame(samples[:, offset:offset + frame.samples], frame)
+            offset += frame.samples
+            self._output.append((frame, received))
+        self._pending = []
+
+    def stop(self):
+        super().stop()
+        if self.track is not None:
+            self.track.stop()
+        if self.windows:
+            logger.info(f'Audio transform: {self.windows} windows, '
+                        f'{self.transform_time / self.windows * 1000:.2f}ms per window')
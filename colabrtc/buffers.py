@@ -0,0 +1,94 @@
+import sys
+import threading
+
+import numpy as np
+
+
+class FramePoolExhausted(MemoryError):
+    """Raised when a buffer would take a `FramePool` over its memory cap."""
+
+
+def _refs(buffers, index):
+    return sys.getrefcount(buffers[index])
+
+
+# references to a pooled buffer that nobody else uses: the pool list and
+# the getrefcount argument (this depends on the interpreter, so it is measured)
+_FREE_REFS = _refs([np.empty(0)], 0)
+
+
+def _is_free(buffers, index):
+    return _refs(buffers, index) <= _FREE_REFS
+
+
+class FramePool:
+    """
+    Reusable frame buffers, by shape and dtype. A buffer is handed out again
+    once nothing references it anymore (including views of it, e.g. a flipped
+    output kept as the last frame), so users never release buffers.
+
+    With `max_bytes`, the buffers of the pool never take more memory than
+    that: free buffers of other shapes (e.g. an old resolution) are evicted
+    first, then `get` raises `FramePoolExhausted`.
+
+    Buffers can be taken from several threads (e.g. `Pipeline` stages).
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.memory = 0
+        # counters: new buffers, and buffers handed out again
+        self.allocations = 0
+        self.allocated_bytes = 0
+        self.reuses = 0
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def get(self, shape, dtype=np.uint8):
+        """Return a buffer of `shape` and `dtype`, with undefined contents."""
+        with self._lock:
+            return self._get(shape, dtype)
+
+    def _get(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype))
+        buffers = self._buffers.setdefault(key, [])
+        for index in range(len(buffers)):
+            if _is_free(buffers, index):
+                self.reuses += 1
+                return buffers[index]
+
+        nbytes = int(np.prod(shape)) * key[1].itemsize
+        if self.max_bytes is not None and self.memory + nbytes > self.max_bytes:
+            self._evict(key)
+            if self.memory + nbytes > self.max_bytes:
+                raise FramePoolExhausted(f'Frame pool is full ({self.memory} of {self.max_bytes} bytes)')
+
+        buffer = np.empty(shape, dtype)
+        buffers.append(buffer)
+        self.memory += nbytes
+        self.allocations += 1
+        self.allocated_bytes += nbytes
+        return buffer
+
+    def _evict(self, keep):
+        for key, buffers in self._buffers.items():
+            if key == keep:
+                continue
+            for index in reversed(range(len(buffers))):
+                if _is_free(buffers, index):
+                    self.memory -= buffers.pop(index).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._buffers = {}
+            self.memory = 0
+
+    @property
+    def metrics(self):
+        return {
+            'buffers': sum(len(buffers) for buffers in self._buffers.values()),
+            'memory': self.memory,
+            'allocations': self.allocations,
+            'allocated_bytes': self.allocated_bytes,
+            'reuses': self.reuses,
+        }
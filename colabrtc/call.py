@@ -1,51 +1,87 @@
+import json
 import os
 
 import nest_asyncio
-from IPython.display import display, Javascript
-from google.colab.output import eval_js
 
-from signaling import ColabSignaling, ColabApprtcSignaling
-from peer import start_peer
+from signaling import ColabSignaling
+from peer import start_peer, PeerPool
 
 nest_asyncio.apply()
 
+# Javascript bundles are read from disk once per process
+_js_bundles = {}
 
-class ColabCall:
-    def __init__(self, signaling_js='js/signaling.js', peer_js='js/peer.js',
-                 peer_ui_js='js/peer-ui.js'):
-        
+
+def load_js_bundle(js_files):
+    js_files = tuple(js_files)
+    if js_files not in _js_bundles:
         file_path = os.path.dirname(os.path.abspath(__file__))
-        js_files = [signaling_js, peer_js, peer_ui_js]
         js_content = []
-        
+
         for js_file in js_files:
             with open(os.path.join(file_path, js_file), 'r') as js:
                 js_content.append(js.read())
 
         js_content.append('''
-          var start_js_peer = function(room) {    
-            new PeerUI(room);
+          var start_js_peer = function(room, controlKeys) {    
+            new PeerUI(room, undefined, controlKeys);
           }
           ''')
-        self._js = ' '.join(js_content)
+        _js_bundles[js_files] = ' '.join(js_content)
+    return _js_bundles[js_files]
+
+
+class ColabCall:
+    def __init__(self, signaling_js='js/signaling.js', peer_js='js/peer.js',
+                 peer_ui_js='js/peer-ui.js'):
+        
+        self._js = load_js_bundle([signaling_js, peer_js, peer_ui_js])
         self._peer_process = None
+        self._peer_pool = None
         self.room = None
         self.signaling_folder = None
 
+    def warm_up(self, size=1, frame_transformer=None, verbose=False):
+        """
+        Start `size` idle peer processes with `frame_transformer` already set
+        up. Subsequent calls to `create` with the same transformer take one
+        of these peers instead of starting from scratch.
+        """
+        self.cool_down()
+        self._peer_pool = PeerPool(size, frame_transformer=frame_transformer,
+                                   verbose=verbose).start()
+
+    def cool_down(self):
+        if self._peer_pool:
+            self._peer_pool.close()
+            self._peer_pool = None
+
     def create(self, room=None, signaling_folder='/content/webrtc',
                frame_transformer=None, verbose=False, multiprocess=True):
 
         self.end()
 
-        room, proc = start_peer(room, signaling_folder=signaling_folder,
-                                frame_transformer=frame_transformer,
-                                verbose=verbose, multiprocess=multiprocess)
+        warm_peer = None
+        pool = self._peer_pool
+        if pool and multiprocess and frame_transformer is pool.frame_transformer:
+            warm_peer = pool.acquire(room, signaling_folder=signaling_folder)
+
+        if warm_peer:
+            room, proc = warm_peer
+        else:
+            room, proc = start_peer(room, signaling_folder=signaling_folder,
+                                    frame_transformer=frame_transformer,
+                                    verbose=verbose, multiprocess=multiprocess)
         self._peer_process = proc
         self.room = room
         self.signaling_folder = signaling_folder
         self.js_signaling = None
 
-    def join(self, room=None, signaling_folder='/content/webrtc', verbose=False):
+    def join(self, room=None, signaling_folder='/content/webrtc', verbose=False, control_keys=None):
+        """
+        `control_keys` maps browser keys to control messages sent to the frame
+        transformer during the call (see `FrameTransformerSession.control`).
+        """
         if self.room is None and room is None:
             raise ValueError('A room parameter must be specified')
         elif self.room:
@@ -58,10 +94,13 @@ class ColabCall:
             self.js_signaling = ColabSignaling(signaling_folder=signaling_folder, 
                                                room=room, javacript_callable=True)
         else:
+            from apprtc import ColabApprtcSignaling
             self.js_signaling = ColabApprtcSignaling(room=room, javacript_callable=True)
 
+        from IPython.display import display, Javascript
+        from google.colab.output import eval_js
         display(Javascript(self._js))
-        eval_js(f'start_js_peer("{room}")')
+        eval_js(f'start_js_peer("{room}", {json.dumps(control_keys or {})})')
         
     def end(self):
         if self._peer_process:
@@ -0,0 +1,133 @@
+import asyncio
+import cProfile
+import logging
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger("colabrtc.instrumentation")
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop runs a callback scheduled every
+    `interval` seconds. Lags over `threshold` are logged, along with the
+    stack of the loop thread while it is stalled (captured from a watchdog
+    thread), which shows the coroutine or callback that blocks the loop.
+
+    With `debug`, the loop also runs in asyncio debug mode, which logs the
+    callbacks (task steps) slower than `threshold` to the 'asyncio' logger.
+    Debug mode slows the loop down, so it is off by default.
+    """
+
+    def __init__(self, interval=.1, threshold=.05, debug=False):
+        self.interval = interval
+        self.threshold = threshold
+        self.debug = debug
+        self.samples = 0
+        self.stalls = 0
+        self.max_lag = 0.
+        self.total_lag = 0.
+        self._heartbeat = None
+        self._loop_thread = None
+        self._task = None
+        self._watchdog = None
+        self._loop = None
+        self._loop_debug = None
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self._loop = loop
+        if self.debug:
+            self._loop_debug = (loop.get_debug(), loop.slow_callback_duration)
+            loop.slow_callback_duration = self.threshold
+            loop.set_debug(True)
+
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = loop.create_task(self._run())
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+        return self
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._loop_debug is not None:
+            debug, self._loop.slow_callback_duration = self._loop_debug
+            self._loop.set_debug(debug)
+            self._loop_debug = None
+        logger.info(f'Loop lag: {self.metrics}')
+
+    @property
+    def metrics(self):
+        return {
+            'samples': self.samples,
+            'stalls': self.stalls,
+            'max_lag': self.max_lag,
+            'mean_lag': self.total_lag / self.samples if self.samples else 0.,
+        }
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag = max(now - expected, 0.)
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stalls += 1
+                logger.warning(f'Event loop lagged {lag * 1000:.0f}ms')
+
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.interval)
+            if self._task is None:
+                # stopped while sleeping: the heartbeat is stale
+                break
+            heartbeat = self._heartbeat
+            if (time.monotonic() - heartbeat > self.interval + self.threshold
+                    and heartbeat != reported):
+                # report each stall once, while the loop is still blocked
+                reported = heartbeat
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    stack = ''.join(traceback.format_stack(frame))
+                    logger.warning(f'Event loop blocked, loop thread stack:\n{stack}')
+
+
+class LoopProfiler:
+    """
+    Profiles the event loop thread with cProfile for `duration` seconds,
+    starting after `delay`, and dumps the stats to `path` (readable with
+    `pstats` or snakeviz).
+    """
+
+    def __init__(self, path, duration=30., delay=0.):
+        self.path = path
+        self.duration = duration
+        self.delay = delay
+        self._profile = None
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        loop.call_later(self.delay, self._enable, loop)
+        return self
+
+    def _enable(self, loop):
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        loop.call_later(self.duration, self.stop)
+
+    def stop(self):
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.path)
+            logger.info(f'Profile written to {self.path}')
+            self._profile = None
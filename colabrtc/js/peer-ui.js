@@ -1,4 +1,4 @@
-var PeerUI = function(room, container_id) {
+var PeerUI = function(room, container_id, controlKeys) {
     // Define initial start time of the call (defined as connection between peers).
     startTime = null;
     constraints = {audio: false, video: true};
@@ -62,6 +62,11 @@ var PeerUI = function(room, container_id) {
     loader.style.display = 'none';
     loader.className = 'loader';
     videoDiv.appendChild(loader);
+    // Metrics of the frames sent by the Python peer
+    const metricsView = document.createElement('div');
+    metricsView.style.fontFamily = 'monospace';
+    metricsView.style.fontSize = 'small';
+    videoDiv.appendChild(metricsView);
 
     // Logs a message with the id and size of a video element.
     function logVideoLoaded(event) {
@@ -108,6 +113,10 @@ var PeerUI = function(room, container_id) {
     this.peerDiv = peerDiv;
     this.videoDiv = videoDiv;
     this.loader = loader;
+    this.metricsView = metricsView;
+    this.metricsUpdate = 0;
+    // Keys sending control messages to the Python frame transformer
+    this.controlKeys = controlKeys || {};
     this.startButton = startButton;
     this.fullscreenButton = fullscreenButton;
     this.hangupButton = hangupButton;
@@ -137,8 +146,16 @@ var PeerUI = function(room, container_id) {
       }
     }
 
+    function onKey(event) {
+        const message = self.controlKeys[event.key];
+        if (message && self.peer && self.peer.sendControl(message)) {
+            event.preventDefault();
+        }
+    }
+
     // Add click event handlers for buttons.
     this.startButton.addEventListener('click', start);
+    document.addEventListener('keydown', onKey);
     this.fullscreenButton.addEventListener('click', openFullscreen);
     this.hangupButton.addEventListener('click', hangup);
 };
@@ -172,15 +189,18 @@ PeerUI.prototype.connect = async function(room) {
         this.startTime = window.performance.now();
 
         this.peer = new Peer();
+        this.peer.onmetrics = (metrics) => this.showMetrics(metrics);
+        this.peer.oncontrol = (reply) => trace(`Control reply: ${JSON.stringify(reply)}`);
         await this.peer.connect(this.room);
         //const obj = JSON.stringify([this.peer.connect, this.room]);
         //this.worker.postMessage([this.peer, this.room]);
 
-        this.peer.pc.ontrack = ({track, streams}) => {
+        this.peer.ontrack = ({track, streams}) => {
             // once media for a remote track arrives, show it in the remote video element
             track.onunmute = () => {
-                // don't set srcObject again if it is already set.
-                if (this.remoteView.srcObject) return;
+                // don't set srcObject again if it is already set (it is not
+                // after a reconnection, which brings a new stream).
+                if (this.remoteView.srcObject == streams[0]) return;
                 console.log(streams);
                 this.remoteView.srcObject = streams[0];
                 trace('Remote peer connection received remote stream.');
@@ -199,6 +219,22 @@ PeerUI.prototype.connect = async function(room) {
     }
 };
 
+PeerUI.prototype.showMetrics = function(metrics) {
+    // metrics arrive with every frame, the view is refreshed 4 times a second
+    const now = window.performance.now();
+    if (now - this.metricsUpdate < 250) {
+        return;
+    }
+    this.metricsUpdate = now;
+    const transform = metrics.transform_ms == null ? '-' : metrics.transform_ms.toFixed(1);
+    this.metricsView.textContent = `frame ${metrics.frame} | transform ${transform}ms | ` +
+        `${metrics.width}x${metrics.height} | dropped ${metrics.frames_dropped}`;
+};
+
+PeerUI.prototype.control = function(message) {
+    return this.peer != null && this.peer.sendControl(message);
+};
+
 PeerUI.prototype.disconnect = async function() {
     await this.peer.disconnect();
     this.startButton.style.display = 'inline';
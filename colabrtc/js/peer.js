@@ -2,7 +2,26 @@ var Peer = function(room, configuration, polite=true) {
     this.makingOffer = false;
     this.ignoreOffer = false;
     this.polite = polite;
-    this.timeout = null;
+    // Local candidates are sent in batches, collected over this window (ms)
+    this.candidateWindow = 50;
+    this.pendingCandidates = [];
+    this.candidateTimeout = null;
+    this.localCandidatesEnd = false;
+    this.remoteCandidatesEnd = false;
+    // Polling delay (ms) once negotiation is over and only BYE is expected
+    this.idlePollDelay = 1000;
+    // How long (ms) the connection may stay disconnected before asking the
+    // Python peer for a new one
+    this.restartDelay = 2000;
+    this.restartTimeout = null;
+    this.localStream = null;
+    // Called with track events, on every (re)connection
+    this.ontrack = null;
+    // Data channels opened by the Python peer: control messages to its frame
+    // transformer (and their replies), and per-frame metrics
+    this.controlChannel = null;
+    this.oncontrol = null;
+    this.onmetrics = null;
 };
 
 Peer.prototype.connect = async function(room, configuration) {
@@ -16,54 +35,19 @@ Peer.prototype.connect = async function(room, configuration) {
           iceServers: [{urls: 'stun:stun.l.google.com:19302'}]
         };
     }
+    this.configuration = configuration;
     
-    pc = new RTCPeerConnection(configuration);
     signaling = new SignalingChannel(room);
     this.signaling = signaling;
-    this.pc = pc;
-    
-    // send any ice candidates to the other peer
-    pc.onicecandidate = async (event) => {
-      if (event.candidate) {
-        trace('Sending ICE candidate');
-        console.log(event);
-        event.candidate.type = 'candidate'
-        await this.signaling.send(event.candidate);
-      }
-    }
-    
-    pc.oniceconnectionstatechange = (event) => {
-      const peerConnection = event.target;
-      trace(`ICE state change: ${peerConnection.iceConnectionState}.`);
-    }
+    this.createPeerConnection();
     
-    // let the "negotiationneeded" event trigger offer generation
-    pc.onnegotiationneeded = async () => {
-      try {
-        trace('making offer');
-        this.makingOffer = true;
-        try {
-          await this.pc.setLocalDescription();
-        } catch (error) {
-          // Some browsers do not support implicit descriptions yet
-          // More info here:
-          // https://developer.mozilla.org/en-US/docs/Web/API/RTCPeerConnection/setLocalDescription#Browser_compatibility
-          // In this case, this peer will only wait for an offer
-        }
-        await this.signaling.send(pc.localDescription);
-      } catch (err) {
-        console.error(err);
-      } finally {
-        this.makingOffer = false;
-      }
-    };
-
     // The perfect negotiation logic, separated from the rest of the application
     // from https://w3c.github.io/webrtc-pc/#perfect-negotiation-example
 
     this.signaling.onmessage = async (message) => {
+      const pc = this.pc;
       try {
-        if (message == null) {
+        if (message == null || pc == null) {
           return;
         }
 
@@ -86,7 +70,7 @@ Peer.prototype.connect = async function(room, configuration) {
               const answer = await pc.createAnswer();
               await pc.setLocalDescription(answer);
             }
-            await signaling.send(this.pc.localDescription);
+            await signaling.send(pc.localDescription);
           }
         } else if (message.type == 'candidate') {
           try {
@@ -94,6 +78,27 @@ Peer.prototype.connect = async function(room, configuration) {
           } catch (err) {
             if (!this.ignoreOffer) throw err; // Suppress ignored offer's candidates
           }
+        } else if (message.type == 'candidates') {
+          // apply the whole batch in one pass
+          try {
+            await Promise.all(message.candidates.map(candidate => pc.addIceCandidate({
+              candidate: candidate.candidate,
+              sdpMid: candidate.id,
+              sdpMLineIndex: candidate.label
+            })));
+          } catch (err) {
+            if (!this.ignoreOffer) throw err;
+          }
+        } else if (message.type == 'end-of-candidates') {
+          this.remoteCandidatesEnd = true;
+          try {
+            await pc.addIceCandidate();
+          } catch (err) {
+            // Older browsers do not accept an empty end-of-candidates
+          }
+        } else if (message.type == 'restart') {
+          // the Python peer replaced its connection, a new offer follows
+          await this.restart();
         } else if (message.type == 'bye') {
             await this.disconnect();
         }
@@ -109,18 +114,157 @@ Peer.prototype.connect = async function(room, configuration) {
     
     const params = await this.signaling.connect();
     this.signalingParams = params;
+    return this.pc;
+};
+
+Peer.prototype.createPeerConnection = function() {
+    const pc = new RTCPeerConnection(this.configuration);
+    this.pc = pc;
+    this.makingOffer = false;
+    this.ignoreOffer = false;
+    this.pendingCandidates = [];
+    this.localCandidatesEnd = false;
+    this.remoteCandidatesEnd = false;
+
+    pc.ontrack = (event) => {
+      if (this.ontrack) {
+        this.ontrack(event);
+      }
+    };
+
+    pc.ondatachannel = ({channel}) => {
+      if (channel.label == 'control') {
+        this.controlChannel = channel;
+        channel.onmessage = (event) => {
+          if (this.oncontrol) {
+            this.oncontrol(JSON.parse(event.data));
+          }
+        };
+      } else if (channel.label == 'metrics') {
+        channel.onmessage = (event) => {
+          if (this.onmetrics) {
+            this.onmetrics(JSON.parse(event.data));
+          }
+        };
+      }
+    };
+    
+    // send ice candidates to the other peer, coalesced in short windows
+    pc.onicecandidate = async (event) => {
+      if (event.candidate) {
+        this.pendingCandidates.push(event.candidate.toJSON());
+        if (this.candidateTimeout == null) {
+          this.candidateTimeout = setTimeout(() => this.flushCandidates(), this.candidateWindow);
+        }
+      } else {
+        // null candidate: gathering is complete
+        await this.flushCandidates(true);
+      }
+    }
+    
+    pc.oniceconnectionstatechange = (event) => {
+      const peerConnection = event.target;
+      trace(`ICE state change: ${peerConnection.iceConnectionState}.`);
+      clearTimeout(this.restartTimeout);
+      if (peerConnection != this.pc) {
+        return;
+      }
+      if (peerConnection.iceConnectionState == 'failed') {
+        this.requestRestart();
+      } else if (peerConnection.iceConnectionState == 'disconnected') {
+        // often recovers by itself after a network blip
+        this.restartTimeout = setTimeout(() => this.requestRestart(), this.restartDelay);
+      }
+    }
+    
+    // let the "negotiationneeded" event trigger offer generation
+    pc.onnegotiationneeded = async () => {
+      try {
+        trace('making offer');
+        this.makingOffer = true;
+        try {
+          await this.pc.setLocalDescription();
+        } catch (error) {
+          // Some browsers do not support implicit descriptions yet
+          // More info here:
+          // https://developer.mozilla.org/en-US/docs/Web/API/RTCPeerConnection/setLocalDescription#Browser_compatibility
+          // In this case, this peer will only wait for an offer
+        }
+        await this.signaling.send(pc.localDescription);
+      } catch (err) {
+        console.error(err);
+      } finally {
+        this.makingOffer = false;
+      }
+    };
+
     return pc;
 };
 
 Peer.prototype.addLocalStream = async function(localStream) {
+    this.localStream = localStream;
     for (const track of localStream.getTracks()) {
         this.pc.addTrack(track, localStream);
         trace(`Adding device: ${track.label}.`);
     }
 };
 
+// Send a control message (an object with a "type") to the Python frame
+// transformer. Returns false if the control channel is not open.
+Peer.prototype.sendControl = function(message) {
+    if (this.controlChannel == null || this.controlChannel.readyState != 'open') {
+        return false;
+    }
+    this.controlChannel.send(JSON.stringify(message));
+    return true;
+};
+
+Peer.prototype.flushCandidates = async function(end=false) {
+    clearTimeout(this.candidateTimeout);
+    this.candidateTimeout = null;
+
+    if (this.pendingCandidates.length > 0) {
+        const candidates = this.pendingCandidates;
+        this.pendingCandidates = [];
+        trace(`Sending ${candidates.length} ICE candidates`);
+        await this.signaling.send({type: 'candidates', candidates: candidates});
+    }
+    if (end && !this.localCandidatesEnd) {
+        this.localCandidatesEnd = true;
+        trace('Sending end of candidates');
+        await this.signaling.send({type: 'end-of-candidates'});
+    }
+};
+
+// Replace the peer connection, keeping the signaling channel and the local
+// stream. The Python peer sends a new offer right after "restart".
+Peer.prototype.restart = async function() {
+    trace('Restarting connection');
+    clearTimeout(this.restartTimeout);
+    clearTimeout(this.candidateTimeout);
+    this.candidateTimeout = null;
+    if (this.pc) {
+        this.pc.close();
+    }
+    this.createPeerConnection();
+    if (this.localStream) {
+        await this.addLocalStream(this.localStream);
+    }
+};
+
+Peer.prototype.requestRestart = async function() {
+    trace('Connection lost, asking for a new one');
+    await this.signaling.send({type: 'restart'});
+};
+
+Peer.prototype.negotiated = function() {
+    return this.pc != null && this.pc.remoteDescription != null &&
+        this.localCandidatesEnd && this.remoteCandidatesEnd;
+};
+
 Peer.prototype.disconnect = async function() {
-    clearTimeout(this.timeout);
+    clearTimeout(this.candidateTimeout);
+    clearTimeout(this.restartTimeout);
     await this.signaling.close();
 
     if (this.pc) {
@@ -130,9 +274,19 @@ Peer.prototype.disconnect = async function() {
 };
 
 Peer.prototype.waitMessage = async function() {
-    await this.signaling.receive();
-    if (this.pc != null) {
-        this.timeout = setTimeout(this.waitMessage, 1000);
+    // Receives return at once; the signaling channel paces them, polling
+    // quickly while messages flow and as soon as a message is sent.
+    while (this.pc != null) {
+        try {
+            const messages = await this.signaling.receive();
+            if (!(messages && messages.length)) {
+                // once candidate exchange is over, only BYE is expected
+                await this.signaling.wait(this.negotiated() ? this.idlePollDelay : undefined);
+            }
+        } catch (err) {
+            console.error(err);
+            await this.signaling.wait(1000);
+        }
     }
 };
 
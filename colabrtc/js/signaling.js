@@ -14,24 +14,70 @@ async function invoke_python(room, action, args) {
   return json;
 }
 
-var SignalingChannel = function(room) {
+var SignalingChannel = function(room, minPollDelay=20, maxPollDelay=500) {
   this.room = room;
+  // Python callbacks run on the kernel thread, one at a time: a receive that
+  // blocked there would hold up every send behind it. So receives return at
+  // once, and the page polls every `minPollDelay` ms while messages flow,
+  // backing off to `maxPollDelay` ms when there are none.
+  this.minPollDelay = minPollDelay;
+  this.maxPollDelay = maxPollDelay;
+  this.pollDelay = minPollDelay;
+  this.wakeup = null;
 
   // Public callbacks. Keep it sorted.
   this.onerror = null;
   this.onmessage = null;
 };
 
+SignalingChannel.prototype.dispatch = async function(messages) {
+  if (!messages) {
+    return;
+  }
+  for (const message of messages) {
+    if (this.onmessage) {
+      await this.onmessage(message);
+    }
+  }
+};
+
 SignalingChannel.prototype.send = async function(message) {
   await invoke_python(this.room, 'send', [JSON.stringify(message)]);
+  // a reply is expected soon, poll for it right away
+  this.pollDelay = this.minPollDelay;
+  if (this.wakeup) {
+    this.wakeup();
+  }
 };
 
 SignalingChannel.prototype.receive = async function() {
-  const message = await invoke_python(this.room, 'receive', []);
-  if (this.onmessage) {
-    this.onmessage(message);
+  // Returns every pending message, without waiting for new ones
+  const messages = await invoke_python(this.room, 'receive_batch', [0]);
+  if (messages && messages.length) {
+    this.pollDelay = this.minPollDelay;
   }
-  return message;
+  await this.dispatch(messages);
+  return messages;
+};
+
+// Waits until the next receive should be made: `delay` ms (by default, the
+// current poll delay, which then backs off), or less if a message is sent.
+SignalingChannel.prototype.wait = function(delay) {
+  if (delay === undefined) {
+    delay = this.pollDelay;
+    this.pollDelay = Math.min(this.pollDelay * 2, this.maxPollDelay);
+  }
+  return new Promise(resolve => {
+    const timeout = setTimeout(() => {
+      this.wakeup = null;
+      resolve();
+    }, delay);
+    this.wakeup = () => {
+      clearTimeout(timeout);
+      this.wakeup = null;
+      resolve();
+    };
+  });
 };
 
 SignalingChannel.prototype.connect = async function() {
@@ -39,5 +85,9 @@ SignalingChannel.prototype.connect = async function() {
 };
 
 SignalingChannel.prototype.close = async function() {
-  return await invoke_python(this.room, 'close', []);
-};
\ No newline at end of file
+  const result = await invoke_python(this.room, 'close', []);
+  if (this.wakeup) {
+    this.wakeup();
+  }
+  return result;
+};
@@ -0,0 +1,133 @@
+import asyncio
+import fractions
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+import av
+import numpy as np
+from av import VideoFrame
+from aiortc.mediastreams import MediaStreamError, VideoStreamTrack
+
+logger = logging.getLogger("colabrtc.media")
+
+VIDEO_CLOCK_RATE = 90000
+VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+
+# clips already loaded by this process, by cache key
+_clips = {}
+
+
+class CachedClip:
+    """
+    The video of a media file, decoded once to raw yuv420p frames. The
+    frames are cached in `cache_dir`, keyed by path and mtime, and
+    memory-mapped, so peers (and peer processes) playing the same file
+    share one copy and never decode it again.
+    """
+
+    def __init__(self, path, cache_dir=None, max_frames=None):
+        self.path = path
+        self._max_frames = max_frames
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), 'colabrtc-clips')
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        abs_path = os.path.abspath(path)
+        key = hashlib.sha1(f'{abs_path}:{os.path.getmtime(abs_path)}:{max_frames}'.encode()).hexdigest()
+        cache_file = os.path.join(self.cache_dir, key)
+        if not os.path.exists(f'{cache_file}.json'):
+            self._decode(cache_file, max_frames)
+
+        with open(f'{cache_file}.json') as f:
+            meta = json.load(f)
+        self.fps = meta['fps']
+        self.width, self.height = meta['width'], meta['height']
+        self.frames = np.memmap(f'{cache_file}.raw', dtype=np.uint8, mode='r',
+                                shape=(meta['frames'], self.height * 3 // 2, self.width))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __reduce__(self):
+        # pickled by path (e.g. for peer processes), not by frames
+        return load_clip, (self.path, self.cache_dir, self._max_frames)
+
+    def _decode(self, cache_file, max_frames):
+        logger.info(f'Decoding {self.path} to {cache_file}')
+        tmp = f'{cache_file}.{uuid.uuid4().hex}.tmp'
+        container = av.open(self.path)
+        stream = container.streams.video[0]
+        fps = float(stream.average_rate or 30)
+        width = height = None
+        count = 0
+        with open(tmp, 'wb') as f:
+            for frame in container.decode(stream):
+                if width is None:
+                    # yuv420p needs even dimensions
+                    width, height = frame.width // 2 * 2, frame.height // 2 * 2
+                frame = frame.reformat(width=width, height=height, format='yuv420p')
+                f.write(frame.to_ndarray().tobytes())
+                count += 1
+                if max_frames and count >= max_frames:
+                    break
+        container.close()
+
+        os.replace(tmp, f'{cache_file}.raw')
+        # the metadata is written last: its presence marks a complete cache
+        meta = dict(fps=fps, width=width, height=height, frames=count)
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, f'{cache_file}.json')
+
+
+def load_clip(path, cache_dir=None, max_frames=None):
+    key = (os.path.abspath(path), cache_dir, max_frames)
+    if key not in _clips:
+        _clips[key] = CachedClip(path, cache_dir=cache_dir, max_frames=max_frames)
+    return _clips[key]
+
+
+class CachedVideoTrack(VideoStreamTrack):
+    """
+    Plays a `CachedClip` in a loop, paced at the clip frame rate.
+    Timestamps keep increasing across loops.
+    """
+
+    def __init__(self, clip):
+        super().__init__()
+        self.clip = clip
+        self._index = 0
+        self._start = None
+
+    async def recv(self):
+        if self.readyState != 'live' or not len(self.clip):
+            raise MediaStreamError
+
+        if self._start is None:
+            self._start = time.time()
+        else:
+            wait = self._start + self._index / self.clip.fps - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        img = self.clip.frames[self._index % len(self.clip)]
+        frame = VideoFrame.from_ndarray(img, format='yuv420p')
+        frame.pts = int(self._index * VIDEO_CLOCK_RATE / self.clip.fps)
+        frame.time_base = VIDEO_TIME_BASE
+        self._index += 1
+        return frame
+
+
+class CachedPlayer:
+    """
+    A drop-in for aiortc's `MediaPlayer` (video only) that plays a file
+    from its decoded cache, looping seamlessly.
+    """
+
+    def __init__(self, file, cache_dir=None, max_frames=None):
+        self.audio = None
+        self.video = CachedVideoTrack(load_clip(file, cache_dir=cache_dir, max_frames=max_frames))
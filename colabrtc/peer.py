@@ -1,10 +1,14 @@
 import argparse
 import asyncio
+import functools
+import inspect
+import json
 import logging
 import os
 import random
+import time
 from abc import ABC, abstractmethod
-from multiprocessing import Process
+from multiprocessing import Process, Queue
 
 # try:
 #     from torch.multiprocessing import Process, set_start_method
@@ -12,8 +16,9 @@ from multiprocessing import Process
 # except (ImportError, RuntimeError):
 #     from multiprocessing import Process
 
-import fire
-import cv2
+# Heavy optional dependencies (cv2, fire, aiortc.contrib.media, AppRTC
+# signaling) are imported where they are used, to keep startup fast.
+import numpy as np
 from av import VideoFrame
 
 from aiortc import (
@@ -23,11 +28,19 @@ from aiortc import (
     VideoStreamTrack,
     RTCConfiguration, RTCIceServer
 )
-from aiortc.mediastreams import MediaStreamError
-from aiortc.contrib.media import MediaBlackhole, MediaPlayer, MediaRecorder, MediaRecorderContext
-from aiortc.contrib.signaling import BYE
-from server import FilesystemRTCServer
-from signaling import ColabSignaling, ColabApprtcSignaling
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+from signaling import ColabSignaling, BYE, END_OF_CANDIDATES, RESTART, POLL_TIMEOUT
+from buffers import FramePool, FramePoolExhausted
+
+# Polling interval once negotiation is complete and only BYE is expected
+IDLE_POLL_INTERVAL = 1
+
+# Data channels: control messages to the frame transformer (reliable) and
+# per-frame metrics to the remote peer (unordered, never retransmitted)
+CONTROL_CHANNEL = 'control'
+METRICS_CHANNEL = 'metrics'
+# Messages are dropped rather than queued past this many buffered bytes
+MAX_CHANNEL_BUFFER = 16384
 
 import pathlib
 THIS_FOLDER = pathlib.Path(__file__).parent.absolute()
@@ -44,9 +57,12 @@ class VideoImageTrack(VideoStreamTrack):
 
     def __init__(self):
         super().__init__()  # don't forget this!
+        import cv2
+        self._cv2 = cv2
         self.img = cv2.imread(PHOTO_PATH, cv2.IMREAD_COLOR)
 
     async def recv(self):
+        cv2 = self._cv2
         pts, time_base = await self.next_timestamp()
         
         # rotate image
@@ -63,6 +79,12 @@ class VideoImageTrack(VideoStreamTrack):
 
 
 class FrameTransformer(ABC):
+    # Pixel format of the frames passed to transform()
+    input_format = 'bgr24'
+    # Size of the frames sent to the remote peer: None sends the transformed
+    # frames as they are, 'source' scales them back to the received size
+    output_size = None
+
     @abstractmethod
     def setup(self):
         ...
@@ -70,40 +92,217 @@ class FrameTransformer(ABC):
     def transform(self, frame, frame_idx):
         ...
 
+    def input_size(self, width, height):
+        """
+        Return the (width, height) received frames should be scaled to before
+        transform(), or None to keep their size. Scaling is done by libswscale
+        during the pixel format conversion, so it costs no extra pass.
+        """
+        return None
+
+    def prepare(self):
+        """
+        Call setup() once. This allows transformers to be set up ahead of time
+        (e.g. in a warm peer pool) without being set up again by the track.
+        """
+        if not getattr(self, '_is_setup', False):
+            self.setup()
+            self._is_setup = True
+
+    def create_session(self):
+        """
+        Create the per-call state used by one `VideoTransformTrack`. Heavy
+        resources (e.g. model weights) belong in the transformer and are
+        loaded once in setup(); anything that changes while a call runs
+        belongs in the session, so one transformer can serve several calls.
+        """
+        return FrameTransformerSession(self)
+
+
+class FrameTransformerSession:
+    """
+    Per-track state of a `FrameTransformer`. The default session has no state
+    and delegates to `FrameTransformer.transform`.
+    """
+
+    # set by the VideoTransformTrack
+    frame_pool = None
+
+    def __init__(self, transformer):
+        self.transformer = transformer
+
+    def buffer(self, shape, dtype=np.uint8):
+        """
+        Return an array to write the output of transform() into. Buffers come
+        from the track's `FramePool` and are reused once the track is done
+        with them, so transforms need not allocate a new frame every time.
+        """
+        if self.frame_pool is None:
+            return np.empty(shape, dtype)
+        return self.frame_pool.get(shape, dtype)
+
+    def transform(self, frame, frame_idx):
+        return self.transformer.transform(frame, frame_idx)
+
+    def control(self, message):
+        """
+        Handle a control message from the remote peer, a dict with a 'type'
+        key, received during the call. A returned dict is sent back.
+        """
+        return None
+
+    def close(self):
+        pass
+
+
+def frame_to_ndarray(frame, size=None, format='bgr24'):
+    if size and size != (frame.width, frame.height):
+        width, height = size
+        frame = frame.reformat(width=width, height=height, format=format)
+    return frame.to_ndarray(format=format)
+
+
+def ndarray_to_frame(img, size=None, format='bgr24'):
+    frame = VideoFrame.from_ndarray(img, format=format)
+    if size and size != (frame.width, frame.height):
+        width, height = size
+        # resize and convert to the encoder's pixel format in a single pass
+        frame = frame.reformat(width=width, height=height, format='yuv420p')
+    return frame
+
+
+class MotionGate:
+    """
+    Skips the frame transformer when a frame barely changed since the last
+    transformed one, so the last output is reused. Frames are compared as
+    small grayscale thumbnails (mean absolute difference, 0-255 scale). A
+    transform is forced at least every `max_skip` frames.
+    """
+
+    def __init__(self, threshold=2., size=(32, 24), max_skip=30):
+        self.threshold = threshold
+        self.size = size
+        self.max_skip = max_skip
+        self.hits = 0
+        self.misses = 0
+        self.transform_time = 0.
+        self.transforms = 0
+        self._reference = None
+        self._skipped = 0
+
+    def should_transform(self, frame):
+        width, height = self.size
+        thumb = frame.reformat(width=width, height=height, format='gray').to_ndarray()
+        thumb = thumb.astype(np.int16)
+        if self._reference is not None and self._skipped < self.max_skip:
+            if np.abs(thumb - self._reference).mean() < self.threshold:
+                self._skipped += 1
+                self.hits += 1
+                return False
+        self._reference = thumb
+        self._skipped = 0
+        self.misses += 1
+        return True
+
+    def record(self, elapsed):
+        self.transform_time += elapsed
+        self.transforms += 1
+
+    @property
+    def metrics(self):
+        total = self.hits + self.misses
+        mean_time = self.transform_time / self.transforms if self.transforms else 0.
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.,
+            'saved_seconds': self.hits * mean_time,
+        }
+
 
 class VideoTransformTrack(VideoStreamTrack):
     """
     A video stream track that returns a rotating image.
     """
 
-    def __init__(self, track, frame_transformer):
+    def __init__(self, track, frame_transformer, motion_gate=None, max_memory=None):
         super().__init__()  # don't forget this!
         
+        # buffers for the transformer session, at most `max_memory` bytes
+        self.frame_pool = FramePool(max_memory)
         if frame_transformer is None:
             frame_transformer = lambda x, y: x
         elif isinstance(frame_transformer, FrameTransformer):
             # frame_transformer = frame_transformer()
-            frame_transformer.setup()
+            frame_transformer.prepare()
+            frame_transformer = frame_transformer.create_session()
+        if isinstance(frame_transformer, FrameTransformerSession):
+            frame_transformer.frame_pool = self.frame_pool
         self.__frame_transformer = frame_transformer
+        self.__transformer = getattr(frame_transformer, 'transformer', None)
         
         self.track = track
         self.frame_idx = 0
         self.last_img = None
+        self.motion_gate = motion_gate
+        # set by a CongestionController: output downscale factor and maximum
+        # frame rate (None for no limit)
+        self.output_scale = 1.
+        self.max_fps = None
+        self._last_time = None
+        # counters for StatsCollector
+        self.frames_received = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        # smoothed time from receiving a frame to sending its output, which
+        # an AudioTransformTrack delays the audio by
+        self.latency = 0.
+        # bytes of the frames built by the track (see bytes_allocated)
+        self._frame_bytes = 0
+        self._blank_img = None
+        # called with the metrics of each frame sent
+        self.on_metrics = None
         
+    @property
+    def track(self):
+        return self._track
+
+    @track.setter
+    def track(self, track):
+        # a new source (e.g. after a reconnect) starts at a random pts
+        self._track = track
+        self._last_time = None
+
+    @property
+    def bytes_allocated(self):
+        """
+        Approximate bytes of frame data allocated so far: the converted input
+        and output frames, and new buffers of the frame pool.
+        """
+        return self._frame_bytes + self.frame_pool.allocated_bytes
+
+    def control(self, message):
+        """Pass a control message to the transformer session, if any."""
+        if isinstance(self.__frame_transformer, FrameTransformerSession):
+            return self.__frame_transformer.control(message)
+
     async def recv(self):
-        if self.track:
-            frame = await self.track.recv()
+        frame = await self._next_frame() if self.track else None
+        if frame is not None:
+            received = time.perf_counter()
+            pts, time_base = frame.pts, frame.time_base
             img = None
-            
-            try:
-                # process video frame
-                frame_img = frame.to_ndarray(format='bgr24')
-                if isinstance(self.__frame_transformer, FrameTransformer):
-                    img = self.__frame_transformer.transform(frame_img, self.frame_idx)
-                else:
-                    img = self.__frame_transformer(frame_img, self.frame_idx)
-            except Exception as ex:
-                logger.error(ex)
+            output_size = self._output_size(frame)
+            elapsed = None
+
+            if (self.motion_gate is None or self.last_img is None or
+                    self.motion_gate.should_transform(frame)):
+                start = time.perf_counter()
+                img = self._transform(frame)
+                elapsed = time.perf_counter() - start
+                if self.motion_gate is not None and img is not None:
+                    self.motion_gate.record(elapsed)
+            # otherwise the frame barely changed: reuse the last output
             
             if img is None and self.last_img is None:
                 img = frame.to_ndarray(format='bgr24')
@@ -114,88 +313,517 @@ class VideoTransformTrack(VideoStreamTrack):
             
             self.frame_idx += 1
         else:
-            img = np.zeros((640, 480, 3))
+            received = None
+            # no remote video, e.g. while reconnecting: repeat the last output
+            pts, time_base = await self.next_timestamp()
+            if self.last_img is None and self._blank_img is None:
+                self._blank_img = np.zeros((480, 640, 3), np.uint8)
+            img = self.last_img if self.last_img is not None else self._blank_img
+            output_size = None
+            elapsed = None
             
+        if self.output_scale < 1:
+            width, height = output_size or (img.shape[1], img.shape[0])
+            # yuv420p needs even dimensions
+            output_size = (int(width * self.output_scale) // 2 * 2,
+                           int(height * self.output_scale) // 2 * 2)
+
         # rebuild a VideoFrame, preserving timing information
-        new_frame = VideoFrame.from_ndarray(img, format='bgr24')
-        new_frame.pts = frame.pts
-        new_frame.time_base = frame.time_base
+        new_frame = ndarray_to_frame(img, output_size)
+        new_frame.pts = pts
+        new_frame.time_base = time_base
+        self._frame_bytes += img.nbytes
+        if output_size:
+            # resized and converted in a second frame
+            self._frame_bytes += sum(plane.buffer_size for plane in new_frame.planes)
+        if received is not None:
+            # e.g. a Pipeline returns the output of earlier frames
+            latency = (time.perf_counter() - received +
+                       getattr(self.__frame_transformer, 'latency', 0.))
+            self.latency += .1 * (latency - self.latency)
+        self.frames_sent += 1
+        if self.on_metrics is not None:
+            self.on_metrics({
+                'type': 'metrics',
+                'frame': self.frame_idx,
+                'transform_ms': elapsed * 1000 if elapsed is not None else None,
+                'width': new_frame.width,
+                'height': new_frame.height,
+                'frames_dropped': self.frames_dropped,
+                'memory': self.frame_pool.memory,
+            })
         return new_frame
-    
 
-async def run(pc, player, recorder, signaling, frame_transformer=None):
+    async def _next_frame(self):
+        track = self.track
+        try:
+            frame = await track.recv()
+            self.frames_received += 1
+            if self.max_fps:
+                # drop frames (before transforming and encoding) above max_fps
+                while self._last_time is not None:
+                    delta = frame.pts * frame.time_base - self._last_time
+                    # a backward jump means the timestamps were reset
+                    if delta < 0 or delta >= 1. / self.max_fps:
+                        break
+                    frame = await track.recv()
+                    self.frames_received += 1
+                    self.frames_dropped += 1
+                self._last_time = frame.pts * frame.time_base
+        except MediaStreamError:
+            if self.track is track:
+                raise
+            # the remote track was replaced while waiting for it
+            return None
+        return frame
+
+    def _output_size(self, frame):
+        if self.__transformer:
+            if self.__transformer.output_size == 'source':
+                return (frame.width, frame.height)
+            elif self.__transformer.output_size:
+                return tuple(self.__transformer.output_size)
+
+    def _transform(self, frame):
+        try:
+            # process video frame
+            if self.__transformer:
+                transformer = self.__transformer
+                frame_img = frame_to_ndarray(frame, transformer.input_size(frame.width, frame.height),
+                                             format=transformer.input_format)
+            else:
+                frame_img = frame.to_ndarray(format='bgr24')
+            self._frame_bytes += frame_img.nbytes
+            if isinstance(self.__frame_transformer, FrameTransformerSession):
+                return self.__frame_transformer.transform(frame_img, self.frame_idx)
+            else:
+                return self.__frame_transformer(frame_img, self.frame_idx)
+        except FramePoolExhausted as ex:
+            # over the memory cap: drop the frame, the last output is repeated
+            self.frames_dropped += 1
+            logger.debug(ex)
+        except Exception as ex:
+            logger.error(ex)
+
+    def stop(self):
+        super().stop()
+        if self.motion_gate is not None:
+            logger.info(f'Motion gate: {self.motion_gate.metrics}')
+        logger.info(f'Frame pool: {self.frame_pool.metrics}')
+        if isinstance(self.__frame_transformer, FrameTransformerSession):
+            self.__frame_transformer.close()
+        # the last output may be a pooled buffer
+        self.last_img = None
+        self.frame_pool.clear()
     
-    video_transform = VideoTransformTrack(None, frame_transformer)
+
+class ConnectionTrack(MediaStreamTrack):
+    """
+    Sends the frames of a longer-lived track over one peer connection.
+    aiortc stops the tracks of a closed connection: only this one is
+    stopped, so the source (and its transformer session) can be sent over
+    the next connection.
+    """
+
+    def __init__(self, source):
+        super().__init__()
+        self.kind = source.kind
+        self.source = source
+
+    async def recv(self):
+        if self.readyState != 'live':
+            raise MediaStreamError
+        return await self.source.recv()
+
+
+class RelayTrack(MediaStreamTrack):
+    """
+    A subscriber of a `VideoRelay`, with its own bounded buffer: when the
+    consumer (e.g. an encoder) falls behind, the oldest frames are dropped.
+    """
+
+    kind = 'video'
+
+    def __init__(self, relay, buffer_size=2):
+        super().__init__()
+        self._relay = relay
+        self._queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = 0
+        # counters for StatsCollector
+        self.frames_received = 0
+        self.frames_sent = 0
+
+    @property
+    def frames_dropped(self):
+        return self.dropped
+
+    def _put(self, frame):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(frame)
+        self.frames_received += 1
+
+    async def recv(self):
+        if self.readyState != 'live':
+            raise MediaStreamError
+        self._relay._start()
+        frame = await self._queue.get()
+        if frame is None:
+            self.stop()
+            raise MediaStreamError
+        self.frames_sent += 1
+        return frame
+
+    def stop(self):
+        super().stop()
+        self._relay._unsubscribe(self)
+
+
+class VideoRelay:
+    """
+    Reads an upstream track (e.g. a `VideoTransformTrack`) once and fans its
+    frames out to any number of subscribers, in the style of aiortc's
+    MediaRelay. Each subscriber is paced independently, so the upstream cost
+    (decode, transform) does not grow with the number of viewers.
+    """
+
+    def __init__(self, track=None, buffer_size=2):
+        self.track = track
+        self.buffer_size = buffer_size
+        self._subscribers = set()
+        self._task = None
+
+    def subscribe(self, buffer_size=None):
+        subscriber = RelayTrack(self, buffer_size or self.buffer_size)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def _unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def _start(self):
+        if self._task is None and self.track is not None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                frame = await self.track.recv()
+            except MediaStreamError:
+                frame = None
+            for subscriber in list(self._subscribers):
+                subscriber._put(frame)
+            if frame is None:
+                break
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for subscriber in list(self._subscribers):
+            subscriber.stop()
+
+
+async def run(pc, player, recorder, signaling, frame_transformer=None, motion_gate=None,
+              relay=None, adapt_output=False, stats_sinks=(), stats_interval=1.,
+              record_source='output', create_pc=None, max_frame_memory=None,
+              audio_transformer=None, audio_window=.06):
+    """
+    If a `VideoRelay` is given, the transformed video is sent through it. The
+    first peer to use the relay feeds it with the video it receives; the
+    other peers only view the relayed video.
+
+    With `adapt_output`, the output resolution and frame rate follow the
+    congestion feedback of the connection (see `CongestionController`).
+
+    If `stats_sinks` are given, connection stats are sampled every
+    `stats_interval` seconds and written to them (see `StatsCollector`).
+    They are shared by the connections of the call, and closed when it ends.
+
+    If the recorder is a `SegmentedRecorder`, `record_source` selects the
+    video it records: 'output' (transformed), 'remote' or 'both'.
+
+    With `create_pc`, a function returning a new `RTCPeerConnection`, a
+    failed connection (or a RESTART request from the other peer) is
+    replaced by a new one, negotiated over the same signaling room. The
+    tracks, and so the transformer session, are kept: only BYE ends the call.
+
+    Control messages received on the 'control' data channel are passed to
+    the transformer session (see `FrameTransformerSession.control`), and the
+    metrics of each frame are sent on the 'metrics' data channel.
+
+    `max_frame_memory` caps the bytes of the buffers the transformer session
+    gets from the track (see `FramePool`); frames are dropped beyond it.
+
+    With an `audio_transformer`, the player audio (or else the remote audio)
+    is transformed in windows of `audio_window` seconds and sent, in sync
+    with the transformed video (see `AudioTransformTrack`).
+    """
     
-    def add_tracks():
-        if player and player.audio:
-            pc.addTrack(player.audio)
+    if relay is not None and relay.track is not None:
+        video_transform = None
+    else:
+        video_transform = VideoTransformTrack(None, frame_transformer, motion_gate=motion_gate,
+                                              max_memory=max_frame_memory)
+        if relay is not None:
+            relay.track = video_transform
+    video_out = relay.subscribe() if relay is not None else video_transform
+    stats_tracks = [video_out]
 
-        if player and player.video:
-            pc.addTrack(player.video)
-        else:
-            pc.addTrack(video_transform)
-            # pc.addTrack(VideoImageTrack())
+    # tee the live tracks into the recorder, which runs off the event loop
+    tee = getattr(recorder, 'tee', None)
+    if tee and record_source in ('output', 'both'):
+        video_out = tee(video_out, name='output' if record_source == 'both' else None)
 
-    @pc.on("track")
-    def on_track(track):
-        logger.debug("Track %s received" % track.kind)
-        #recorder.addTrack(track)
-        
-        if track.kind == 'video':
-            #pc.addTrack(local_video)
-            video_transform.track = track
+    audio_out = player and player.audio
+    audio_transform = None
+    if audio_transformer is not None:
+        from audio import AudioTransformTrack
+        audio_transform = AudioTransformTrack(audio_out, audio_transformer, window=audio_window,
+                                              video_track=video_transform)
+        audio_out = audio_transform
 
-    # connect to websocket and join
-    params = await signaling.connect()
-    if params["is_initiator"] == True:
+    if player and player.video:
+        sources = [audio_out, player.video]
+    else:
+        sources = [audio_out, video_out]
+    sources = [track for track in sources if track is not None]
+    restart_needed = asyncio.Event()
+
+    def setup_channel(channel):
+        if channel.label == CONTROL_CHANNEL:
+            @channel.on("message")
+            def on_message(message):
+                if video_transform is None:
+                    return
+                try:
+                    reply = video_transform.control(json.loads(message))
+                except Exception as err:
+                    logger.error(f'Control message {message!r} failed: {err}')
+                    return
+                if reply is not None:
+                    send_channel_message(channel, reply)
+        elif channel.label == METRICS_CHANNEL and video_transform is not None:
+            video_transform.on_metrics = functools.partial(send_channel_message, channel)
+
+    # one stats collector per connection, all writing to `stats_sinks`
+    collectors = []
+
+    def setup_connection(pc):
+        if adapt_output and video_transform is not None:
+            from adaptation import CongestionController
+            CongestionController(pc, video_transform).start()
+
+        if stats_sinks:
+            from stats import StatsCollector
+            collector = StatsCollector(pc, stats_sinks, tracks=stats_tracks, interval=stats_interval,
+                                       label=signaling.room).start()
+            collectors.append(collector)
+
+            @pc.on("signalingstatechange")
+            def on_signalingstatechange():
+                # the sinks are shared with the next connection
+                if pc.signalingState == 'closed':
+                    collector.stop()
+
+        @pc.on("iceconnectionstatechange")
+        def on_iceconnectionstatechange():
+            logger.debug(f'ICE connection state: {pc.iceConnectionState}')
+            if pc.iceConnectionState == 'failed' and create_pc is not None:
+                restart_needed.set()
+
+        @pc.on("datachannel")
+        def on_datachannel(channel):
+            setup_channel(channel)
+
+        @pc.on("track")
+        def on_track(track):
+            logger.debug("Track %s received" % track.kind)
+            #recorder.addTrack(track)
+            
+            if track.kind == 'video' and video_transform is not None:
+                #pc.addTrack(local_video)
+                if tee and record_source in ('remote', 'both'):
+                    track = tee(track, name='remote' if record_source == 'both' else None)
+                video_transform.track = track
+            elif (track.kind == 'audio' and audio_transform is not None and
+                  not (player and player.audio)):
+                audio_transform.track = track
+
+    def add_tracks():
+        for track in sources:
+            pc.addTrack(ConnectionTrack(track))
+            # pc.addTrack(VideoImageTrack())
+
+    async def send_offer():
         # send offer
         logger.debug('Sending OFFER...')
         add_tracks()
+        setup_channel(pc.createDataChannel(CONTROL_CHANNEL))
+        setup_channel(pc.createDataChannel(METRICS_CHANNEL, ordered=False, maxRetransmits=0))
         await pc.setLocalDescription(await pc.createOffer())
         await signaling.send(pc.localDescription)
-        
-    # consume signaling
-    while True:
-        # print('>> Python: Waiting for SDP message...')
-        obj = await signaling.receive()
-        if obj is None:
-            await asyncio.sleep(1)
-            continue
-
-        if isinstance(obj, RTCSessionDescription):
-            logger.debug(obj.type, pc.signalingState)
-            if obj.type == 'answer' and pc.signalingState == 'stable':
-                continue
-            if obj.type == "offer" and pc.signalingState == 'have-local-offer':
+        # aiortc gathers all candidates before creating the description
+        await signaling.send(END_OF_CANDIDATES)
+
+    setup_connection(pc)
+    original_pc = pc
+
+    # connect to websocket and join
+    params = await signaling.connect()
+    if params["is_initiator"] == True:
+        await send_offer()
+
+    remote_candidates_end = False
+    recorder_started = False
+
+    try:
+        # consume signaling
+        while True:
+            if restart_needed.is_set():
+                restart_needed.clear()
+                logger.info('Connection failed, reconnecting')
+                # the transform track shows its last output until the new
+                # connection delivers remote video
+                if video_transform is not None:
+                    video_transform.track = None
+                await pc.close()
+                pc = create_pc()
+                setup_connection(pc)
+                remote_candidates_end = False
+                await signaling.send(RESTART)
+                await send_offer()
+
+            # print('>> Python: Waiting for SDP message...')
+            messages = await signaling.receive_batch(timeout=POLL_TIMEOUT)
+            if not messages:
+                if remote_candidates_end and pc.remoteDescription:
+                    # negotiation is over, only wait for BYE
+                    await asyncio.sleep(IDLE_POLL_INTERVAL)
                 continue
-                
-            logger.debug(f'Received {obj.type.upper()}:', str(obj)[:100])
-            await pc.setRemoteDescription(obj)
-            await recorder.start()
-
-#             if obj.type == "offer":
-#                 # send answer
-#                 # add_tracks()
-#                 logger.info('Sending ANSWER...')
-#                 await pc.setLocalDescription(await pc.createAnswer())
-#                 await signaling.send(pc.localDescription)
-                
-        elif isinstance(obj, RTCIceCandidate):
-            logger.debug('Received ICE candidate:', obj)
-            pc.addIceCandidate(obj)
-        elif obj is BYE:
-            logger.debug('Received BYE')
-            logger.debug("Exiting")
-            break
-            
 
-def run_process(pc, player, recorder, signaling, frame_transformer):
+            candidates = []
+            candidates_end = False
+            for obj in messages:
+                if isinstance(obj, RTCSessionDescription):
+                    logger.debug(obj.type, pc.signalingState)
+                    if obj.type == 'answer' and pc.signalingState == 'stable':
+                        continue
+                    if obj.type == "offer" and pc.signalingState == 'have-local-offer':
+                        continue
+
+                    logger.debug(f'Received {obj.type.upper()}:', str(obj)[:100])
+                    await pc.setRemoteDescription(obj)
+                    if not recorder_started:
+                        await recorder.start()
+                        recorder_started = True
+
+#                     if obj.type == "offer":
+#                         # send answer
+#                         # add_tracks()
+#                         logger.info('Sending ANSWER...')
+#                         await pc.setLocalDescription(await pc.createAnswer())
+#                         await signaling.send(pc.localDescription)
+
+                elif pc.remoteDescription is None and (
+                        isinstance(obj, (RTCIceCandidate, list)) or obj is END_OF_CANDIDATES):
+                    # the remote peer sends its answer before its candidates, so
+                    # these are left from a replaced connection
+                    logger.debug('Ignoring ICE candidates received before the answer')
+                elif isinstance(obj, RTCIceCandidate):
+                    candidates.append(obj)
+                elif isinstance(obj, list):
+                    candidates.extend(obj)
+                elif obj is END_OF_CANDIDATES:
+                    logger.debug('Received end of candidates')
+                    remote_candidates_end = candidates_end = True
+                elif obj is RESTART:
+                    # ignored while a new connection is being established
+                    if create_pc is not None and pc.iceConnectionState not in ('new', 'checking'):
+                        logger.debug('Received RESTART')
+                        restart_needed.set()
+                elif obj is BYE:
+                    logger.debug('Received BYE')
+                    logger.debug("Exiting")
+                    return
+
+            # apply the whole batch of candidates in one pass
+            if candidates or candidates_end:
+                logger.debug(f'Received {len(candidates)} ICE candidates')
+                await add_ice_candidates(pc, candidates, end=candidates_end)
+    finally:
+        if pc is not original_pc:
+            await pc.close()
+        # the tracks outlive the connections, stop them with the call
+        for track in sources:
+            track.stop()
+        for collector in collectors:
+            collector.stop()
+        for sink in stats_sinks:
+            sink.close()
+
+
+def send_channel_message(channel, message):
+    if channel.readyState == 'open' and channel.bufferedAmount < MAX_CHANNEL_BUFFER:
+        channel.send(json.dumps(message))
+
+
+async def add_ice_candidates(pc, candidates, end=False):
+    for candidate in candidates:
+        result = pc.addIceCandidate(candidate)
+        # addIceCandidate is a coroutine in newer aiortc versions
+        if asyncio.iscoroutine(result):
+            await result
+
+    if end:
+        # let ICE know no more remote candidates are coming, so connectivity
+        # checks can complete (or fail) without waiting for more
+        for transceiver in pc.getTransceivers():
+            try:
+                result = transceiver.receiver.transport.transport.addRemoteCandidate(None)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as err:
+                logger.debug(f'Could not signal end of candidates: {err}')
+
+
+def run_process(pc, player, recorder, signaling, frame_transformer, motion_gate=None,
+                adapt_output=False, stats_file=None, stats_interval=1., record_source='output',
+                lag_threshold=None, profile_to=None, profile_duration=30., ice_servers=None,
+                max_frame_memory=None, audio_transformer=None, audio_window=.06,
+                lag_debug=False):
+    """
+    With `lag_threshold` (in seconds), event loop lags and stalls longer
+    than it are logged (see `LoopLagMonitor`), and with `lag_debug` the
+    slow callbacks too, in asyncio debug mode. With `profile_to`, the first
+    `profile_duration` seconds of the peer are profiled to that file.
+
+    A failed connection is replaced by a new one using `ice_servers`,
+    keeping the process and the frame transformer.
+    """
+    # sinks are created here, in the peer process
+    stats_sinks = []
+    if stats_file:
+        from stats import JsonLinesSink
+        stats_sinks.append(JsonLinesSink(stats_file))
+    loop = asyncio.get_event_loop()
+    lag_monitor = profiler = None
+    if lag_threshold:
+        from instrumentation import LoopLagMonitor
+        lag_monitor = LoopLagMonitor(threshold=lag_threshold, debug=lag_debug).start(loop)
+    if profile_to:
+        from instrumentation import LoopProfiler
+        profiler = LoopProfiler(profile_to, duration=profile_duration).start(loop)
     try:
         # run event loop
-        loop = asyncio.get_event_loop()
         loop.run_until_complete(
-            run(pc=pc, player=player, recorder=recorder, signaling=signaling, frame_transformer=frame_transformer)
+            run(pc=pc, player=player, recorder=recorder, signaling=signaling, frame_transformer=frame_transformer,
+                motion_gate=motion_gate, adapt_output=adapt_output, stats_sinks=stats_sinks,
+                stats_interval=stats_interval, record_source=record_source,
+                create_pc=functools.partial(create_peer_connection, ice_servers),
+                max_frame_memory=max_frame_memory, audio_transformer=audio_transformer,
+                audio_window=audio_window)
         )
     except KeyboardInterrupt:
         pass
@@ -204,50 +832,269 @@ def run_process(pc, player, recorder, signaling, frame_transformer):
         loop.run_until_complete(recorder.stop())
         loop.run_until_complete(signaling.close())
         loop.run_until_complete(pc.close())
+        if lag_monitor is not None:
+            lag_monitor.stop()
+        if profiler is not None:
+            profiler.stop()
 
 
-def start_peer(room=None, signaling_folder=None, play_from=None, record_to=None, 
-               frame_transformer=None, verbose=False, ice_servers=None, multiprocess=False):
-    
-    if verbose:
-        logging.basicConfig(level=logging.DEBUG)
-    else:
-        logging.basicConfig(level=logging.INFO)
-
+def create_peer_connection(ice_servers=None):
     if ice_servers:
         logger.debug('Using ICE servers:', ice_servers)
         servers = [RTCIceServer(*server) if type(server) == tuple else RTCIceServer(server) for server in ice_servers]
-        pc = RTCPeerConnection(
-            configuration=RTCConfiguration(servers))
-    else:
-        pc = RTCPeerConnection()
-    
+        return RTCPeerConnection(configuration=RTCConfiguration(servers))
+    return RTCPeerConnection()
+
+
+def create_signaling(room=None, signaling_folder=None, trace_to=None):
     # room = str(room)
+    if signaling_folder and trace_to:
+        from server import FilesystemRTCServer
+        from tracing import TraceRecorder
+        server = TraceRecorder(FilesystemRTCServer(folder=signaling_folder), trace_to)
+        return ColabSignaling(webrtc_server=server, room=room)
     if signaling_folder:
-        signaling = ColabSignaling(signaling_folder=signaling_folder, room=room)
-    else:
-        signaling = ColabApprtcSignaling(room=room)
-        
+        return ColabSignaling(signaling_folder=signaling_folder, room=room)
+    from apprtc import ColabApprtcSignaling
+    return ColabApprtcSignaling(room=room)
+
+
+def create_media(play_from=None, record_to=None, record_segment=None, record_max_segments=None,
+                 play_cached=False):
     # create media source
-    if play_from:
+    if play_from and play_cached:
+        # decoded once and shared by all peers, looping
+        from media import CachedPlayer
+        player = CachedPlayer(play_from)
+    elif play_from:
+        from aiortc.contrib.media import MediaPlayer
         player = MediaPlayer(play_from)
     else:
         player = None
 
     # create media sink
     if record_to:
-        recorder = MediaRecorder(record_to)
+        from recording import SegmentedRecorder
+        recorder = SegmentedRecorder(record_to, segment_duration=record_segment,
+                                     max_segments=record_max_segments)
     else:
+        from aiortc.contrib.media import MediaBlackhole
         recorder = MediaBlackhole()
+    return player, recorder
+
+
+def _setup_logging(verbose):
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+
+def start_peer(room=None, signaling_folder=None, play_from=None, record_to=None, 
+               frame_transformer=None, verbose=False, ice_servers=None, multiprocess=False,
+               motion_threshold=None, adapt_output=False, stats_file=None, stats_interval=1.,
+               record_source='output', record_segment=None, record_max_segments=None,
+               play_cached=False, lag_threshold=None, profile_to=None, profile_duration=30.,
+               trace_to=None, max_frame_memory=None, audio_transformer=None, audio_window=.06,
+               lag_debug=False):
+    """
+    If `motion_threshold` is set, frames whose mean absolute difference to
+    the last transformed frame is below it are not transformed (see
+    `MotionGate`). With `adapt_output`, the output resolution and frame rate
+    adapt to congestion feedback. With `stats_file`, connection stats are
+    appended to it as JSON lines every `stats_interval` seconds.
+
+    With `record_to`, the `record_source` video ('output', 'remote' or
+    'both') is recorded from a separate thread, split in `record_segment`
+    second files if set, keeping the last `record_max_segments`.
+
+    With `play_cached`, the `play_from` video is decoded once, cached and
+    played in a loop (see `CachedPlayer`), e.g. as load test input.
+
+    `lag_threshold`, `lag_debug`, `profile_to` and `profile_duration`
+    instrument the peer event loop (see `run_process`).
+
+    With `trace_to`, the signaling messages of the peer are recorded to
+    that file, to be replayed with `tracing.replay` (filesystem signaling
+    only). `max_frame_memory` caps the frame buffers of the transformer, in
+    bytes, and `audio_transformer` transforms the audio in `audio_window`
+    second windows (see `run`).
+    """
+    
+    _setup_logging(verbose)
+    pc = create_peer_connection(ice_servers)
+    signaling = create_signaling(room, signaling_folder, trace_to=trace_to)
+    player, recorder = create_media(play_from, record_to, record_segment, record_max_segments,
+                                    play_cached=play_cached)
+    motion_gate = MotionGate(motion_threshold) if motion_threshold else None
         
     if multiprocess:
-        p = Process(target=run_process, args=(pc, player, recorder, signaling, frame_transformer))
+        p = Process(target=run_process, args=(pc, player, recorder, signaling, frame_transformer),
+                    kwargs=dict(motion_gate=motion_gate, adapt_output=adapt_output,
+                                stats_file=stats_file, stats_interval=stats_interval,
+                                record_source=record_source, lag_threshold=lag_threshold,
+                                profile_to=profile_to, profile_duration=profile_duration,
+                                ice_servers=ice_servers, max_frame_memory=max_frame_memory,
+                                audio_transformer=audio_transformer, audio_window=audio_window,
+                                lag_debug=lag_debug))
         p.start()
         return signaling.room, p
     else:
-        run_process(pc, player, recorder, signaling, frame_transformer)
+        run_process(pc, player, recorder, signaling, frame_transformer, motion_gate=motion_gate,
+                    adapt_output=adapt_output, stats_file=stats_file, stats_interval=stats_interval,
+                    record_source=record_source, lag_threshold=lag_threshold,
+                    profile_to=profile_to, profile_duration=profile_duration,
+                    ice_servers=ice_servers, max_frame_memory=max_frame_memory,
+                    audio_transformer=audio_transformer, audio_window=audio_window,
+                    lag_debug=lag_debug)
         return signaling.room, None
+
+
+def run_broadcast_process(peers, frame_transformer, relay, motion_gate=None, stats_file=None,
+                          stats_interval=1., ice_servers=None, max_frame_memory=None):
+    def stats_sinks():
+        # one sink per peer, each run() closes its own
+        if stats_file:
+            from stats import JsonLinesSink
+            return [JsonLinesSink(stats_file)]
+        return []
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(asyncio.gather(*[
+            run(pc=pc, player=None, recorder=recorder, signaling=signaling,
+                frame_transformer=frame_transformer, motion_gate=motion_gate, relay=relay,
+                stats_sinks=stats_sinks(), stats_interval=stats_interval,
+                create_pc=functools.partial(create_peer_connection, ice_servers),
+                max_frame_memory=max_frame_memory)
+            for pc, recorder, signaling in peers
+        ]))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.stop()
+        for pc, recorder, signaling in peers:
+            loop.run_until_complete(recorder.stop())
+            loop.run_until_complete(signaling.close())
+            loop.run_until_complete(pc.close())
+
+
+def start_broadcast(room=None, viewer_rooms=(), signaling_folder=None, frame_transformer=None,
+                    verbose=False, ice_servers=None, multiprocess=False, buffer_size=2,
+                    motion_threshold=None, stats_file=None, stats_interval=1.,
+                    max_frame_memory=None):
+    """
+    Transform the video received in `room` once and send it to the peers in
+    `room` and in each of `viewer_rooms`, all from the same process.
+    Returns the list of rooms (publisher first) and the process, if any.
+    Stats samples of all the peers go to `stats_file`, labelled by room.
+    """
+    _setup_logging(verbose)
+    relay = VideoRelay(buffer_size=buffer_size)
+    motion_gate = MotionGate(motion_threshold) if motion_threshold else None
+    peers = []
+    for peer_room in [room, *viewer_rooms]:
+        _, recorder = create_media()
+        peers.append((create_peer_connection(ice_servers), recorder,
+                      create_signaling(peer_room, signaling_folder)))
+    rooms = [signaling.room for _, _, signaling in peers]
+
+    if multiprocess:
+        p = Process(target=run_broadcast_process, args=(peers, frame_transformer, relay),
+                    kwargs=dict(motion_gate=motion_gate, stats_file=stats_file,
+                                stats_interval=stats_interval, ice_servers=ice_servers,
+                                max_frame_memory=max_frame_memory))
+        p.start()
+        return rooms, p
+    else:
+        run_broadcast_process(peers, frame_transformer, relay, motion_gate=motion_gate,
+                              stats_file=stats_file, stats_interval=stats_interval,
+                              ice_servers=ice_servers, max_frame_memory=max_frame_memory)
+        return rooms, None
+
+
+def run_warm_process(queue, frame_transformer, play_from=None, record_to=None,
+                     ice_servers=None, verbose=False, motion_threshold=None,
+                     record_segment=None, record_max_segments=None, play_cached=False,
+                     **run_kwargs):
+    """
+    Set up the frame transformer, then wait for a signaling assignment and
+    run the peer. The expensive setup happens before the call is created.
+    The other options are those of `run_process`.
+    """
+    _setup_logging(verbose)
+    if isinstance(frame_transformer, FrameTransformer):
+        frame_transformer.prepare()
+
+    signaling = queue.get()
+    if signaling is None:
+        return
+    pc = create_peer_connection(ice_servers)
+    player, recorder = create_media(play_from, record_to, record_segment, record_max_segments,
+                                    play_cached=play_cached)
+    motion_gate = MotionGate(motion_threshold) if motion_threshold else None
+    run_process(pc, player, recorder, signaling, frame_transformer, motion_gate=motion_gate,
+                ice_servers=ice_servers, **run_kwargs)
+
+
+class PeerPool:
+    """
+    Keeps `size` idle peer processes with their frame transformer already set
+    up, so a call can be started without waiting for model loading. The
+    peers are started with `peer_kwargs`, the options of `start_peer` except
+    `room` and `signaling_folder` (given to `acquire`), `multiprocess` and
+    `trace_to`.
+    """
+
+    def __init__(self, size=1, frame_transformer=None, **peer_kwargs):
+        # fail here rather than in the peer process
+        options = (set(inspect.signature(run_warm_process).parameters) |
+                   set(inspect.signature(run_process).parameters))
+        options -= {'queue', 'frame_transformer', 'run_kwargs', 'pc', 'player', 'recorder',
+                    'signaling', 'motion_gate'}
+        unsupported = sorted(set(peer_kwargs) - options)
+        if unsupported:
+            raise TypeError(f'PeerPool does not support the peer options {unsupported}')
+        self.size = size
+        self.frame_transformer = frame_transformer
+        self._peer_kwargs = peer_kwargs
+        self._idle = []
+
+    def _spawn(self):
+        queue = Queue(1)
+        p = Process(target=run_warm_process, args=(queue, self.frame_transformer),
+                    kwargs=self._peer_kwargs)
+        p.start()
+        self._idle.append((p, queue))
+
+    def start(self):
+        while len(self._idle) < self.size:
+            self._spawn()
+        return self
+
+    def acquire(self, room=None, signaling_folder=None):
+        """
+        Hand an idle peer process over to a signaling room. Returns the room
+        and process, as `start_peer`, or `None` if there is no idle peer.
+        """
+        while self._idle:
+            p, queue = self._idle.pop(0)
+            if not p.is_alive():
+                continue
+            signaling = create_signaling(room, signaling_folder)
+            queue.put(signaling)
+            self.start()
+            return signaling.room, p
+
+    def close(self):
+        for p, queue in self._idle:
+            queue.put(None)
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
+        self._idle = []
      
     
 if __name__ == '__main__':
-     fire.Fire(start_peer)
+    import fire
+    fire.Fire(start_peer)
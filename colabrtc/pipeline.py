@@ -0,0 +1,224 @@
+import logging
+import queue
+import threading
+import time
+
+from buffers import FramePoolExhausted
+from peer import FrameTransformer, FrameTransformerSession
+
+logger = logging.getLogger("colabrtc.pipeline")
+
+
+def _apply(transformer, data, frame_idx):
+    # a transformer (session) or a plain function
+    if isinstance(transformer, (FrameTransformer, FrameTransformerSession)):
+        return transformer.transform(data, frame_idx)
+    return transformer(data, frame_idx)
+
+
+class Stage:
+    """
+    A step of a `Pipeline`: a `FrameTransformer` or a `transform(data,
+    frame_idx)` callable. With `thread`, the stage runs on its own worker
+    thread; otherwise it runs on the thread of the previous stage.
+    """
+
+    def __init__(self, transformer, thread=True):
+        self.transformer = transformer
+        self.thread = thread
+
+    @property
+    def name(self):
+        transformer = self.transformer
+        return getattr(transformer, '__name__', type(transformer).__name__)
+
+
+class Pipeline(FrameTransformer):
+    """
+    Chains stages (e.g. detect, crop, model, pad), each of which gets the
+    output of the previous one. A stage returning None drops the frame.
+
+    In a `VideoTransformTrack`, threaded stages run on worker threads
+    connected by queues of at most `queue_size` frames, so successive frames
+    are processed by different stages at the same time: throughput follows
+    the slowest stage, at the cost of a few frames of latency. New frames
+    are dropped when the first stage is busy, and the track repeats its last
+    output until the pipeline delivers a new one.
+    """
+
+    def __init__(self, stages, queue_size=1):
+        self.stages = [stage if isinstance(stage, Stage) else Stage(stage) for stage in stages]
+        if not self.stages:
+            raise ValueError('A pipeline needs at least one stage')
+        self.queue_size = queue_size
+        first, last = self.stages[0].transformer, self.stages[-1].transformer
+        self.input_format = getattr(first, 'input_format', FrameTransformer.input_format)
+        self.output_size = getattr(last, 'output_size', FrameTransformer.output_size)
+
+    def input_size(self, width, height):
+        first = self.stages[0].transformer
+        if isinstance(first, FrameTransformer):
+            return first.input_size(width, height)
+
+    def setup(self):
+        for stage in self.stages:
+            if isinstance(stage.transformer, FrameTransformer):
+                stage.transformer.prepare()
+
+    def transform(self, frame, frame_idx):
+        # Used when called directly, outside of a VideoTransformTrack: all
+        # the stages run in turn, on the calling thread
+        for stage in self.stages:
+            frame = _apply(stage.transformer, frame, frame_idx)
+            if frame is None:
+                return None
+        return frame
+
+    def create_session(self):
+        return PipelineSession(self)
+
+
+class PipelineSession(FrameTransformerSession):
+    """
+    Per-track state of a `Pipeline`: the sessions of its stages and the
+    worker threads running them.
+    """
+
+    def __init__(self, pipeline):
+        super().__init__(pipeline)
+        self._frame_pool = None
+        self._sessions = [stage.transformer.create_session()
+                          if isinstance(stage.transformer, FrameTransformer) else stage.transformer
+                          for stage in pipeline.stages]
+        self.dropped = 0
+        self._times = [0.] * len(self._sessions)
+        self._counts = [0] * len(self._sessions)
+        self._result = None
+        self._lock = threading.Lock()
+
+        # stages before the first threaded one run in the caller, then each
+        # threaded stage starts a group run by one worker
+        self._inline = []
+        groups = []
+        for index, stage in enumerate(pipeline.stages):
+            if stage.thread:
+                groups.append([index])
+            elif groups:
+                groups[-1].append(index)
+            else:
+                self._inline.append(index)
+
+        self._queues = [queue.Queue(maxsize=pipeline.queue_size) for _ in groups]
+        self._threads = []
+        for index, group in enumerate(groups):
+            out_queue = self._queues[index + 1] if index + 1 < len(groups) else None
+            thread = threading.Thread(target=self._work, args=(group, self._queues[index], out_queue),
+                                      name=f'pipeline-{pipeline.stages[group[0]].name}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def frame_pool(self):
+        return self._frame_pool
+
+    @frame_pool.setter
+    def frame_pool(self, frame_pool):
+        # stage sessions write into the buffers of the track
+        self._frame_pool = frame_pool
+        for session in self._sessions:
+            if isinstance(session, FrameTransformerSession):
+                session.frame_pool = frame_pool
+
+    def _run_stages(self, indices, data, frame_idx):
+        for index in indices:
+            start = time.perf_counter()
+            data = _apply(self._sessions[index], data, frame_idx)
+            self._times[index] += time.perf_counter() - start
+            self._counts[index] += 1
+            if data is None:
+                return None
+        return data
+
+    def _work(self, group, in_queue, out_queue):
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            frame_idx, data = item
+            try:
+                data = self._run_stages(group, data, frame_idx)
+            except FramePoolExhausted as ex:
+                self.dropped += 1
+                logger.debug(ex)
+                continue
+            except Exception as ex:
+                logger.error(ex)
+                continue
+            if data is None:
+                continue
+            if out_queue is not None:
+                # wait for the next stage, which is the bottleneck
+                out_queue.put((frame_idx, data))
+            else:
+                with self._lock:
+                    self._result = data
+        if out_queue is not None:
+            out_queue.put(None)
+
+    def transform(self, frame, frame_idx):
+        """
+        Run the inline stages and hand the frame to the workers. Returns the
+        latest output of the pipeline not returned yet, if any.
+        """
+        data = self._run_stages(self._inline, frame, frame_idx)
+        if not self._queues:
+            return data
+
+        if data is not None:
+            try:
+                self._queues[0].put_nowait((frame_idx, data))
+            except queue.Full:
+                self.dropped += 1
+        with self._lock:
+            result, self._result = self._result, None
+        return result
+
+    def control(self, message):
+        replies = [session.control(message) for session in self._sessions
+                   if isinstance(session, FrameTransformerSession)]
+        return next((reply for reply in replies if reply is not None), None)
+
+    @property
+    def latency(self):
+        """Mean time a frame spends in the worker stages, queues aside."""
+        inline = set(self._inline)
+        return sum(self._times[index] / self._counts[index]
+                   for index in range(len(self._sessions))
+                   if index not in inline and self._counts[index])
+
+    @property
+    def metrics(self):
+        return {
+            'dropped': self.dropped,
+            'stage_ms': {stage.name: self._times[index] / self._counts[index] * 1000
+                         for index, stage in enumerate(self.transformer.stages)
+                         if self._counts[index]},
+        }
+
+    def close(self):
+        if self._queues:
+            # the first worker may be busy with a full queue, make room
+            first = self._queues[0]
+            while True:
+                try:
+                    first.get_nowait()
+                except queue.Empty:
+                    break
+            first.put(None)
+            for thread in self._threads:
+                thread.join(timeout=1)
+            self._queues = []
+        logger.info(f'Pipeline: {self.metrics}')
+        for session in self._sessions:
+            if isinstance(session, FrameTransformerSession):
+                session.close()
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+
+import av
+from aiortc.mediastreams import MediaStreamTrack
+
+logger = logging.getLogger("colabrtc.recording")
+
+
+class TeeTrack(MediaStreamTrack):
+    """
+    Passes the frames of `track` through, handing each of them to a
+    `SegmentedRecorder` without waiting for it.
+    """
+
+    def __init__(self, track, recorder, name=None):
+        super().__init__()
+        self.kind = track.kind
+        self.track = track
+        self.name = name
+        self._recorder = recorder
+
+    async def recv(self):
+        frame = await self.track.recv()
+        self._recorder._put(self, frame)
+        return frame
+
+    def stop(self):
+        super().stop()
+        self.track.stop()
+
+
+class SegmentedRecorder:
+    """
+    Records video tracks from a writer thread, so encoding and slow disks
+    never stall the live tracks: frames are queued (at most `queue_size`)
+    and dropped when the queue is full.
+
+    Each teed track is written to its own files, suffixed with the tee
+    name if any. With `segment_duration` (in seconds), the recording is
+    split into `<name>_00000<ext>`, `<name>_00001<ext>`, ... and only the
+    last `max_segments` files of each track are kept, if set.
+    """
+
+    def __init__(self, path, segment_duration=None, max_segments=None, queue_size=30,
+                 codec='libx264', fps=30):
+        self.path = path
+        self.segment_duration = segment_duration
+        self.max_segments = max_segments
+        self.queue_size = queue_size
+        self.codec = codec
+        self.fps = fps
+        self.dropped = 0
+        self.segments = {}
+        self._queue = None
+        self._thread = None
+
+    def tee(self, track, name=None):
+        """Return a track to use instead of `track`, whose frames are recorded."""
+        return TeeTrack(track, self, name=name)
+
+    async def start(self):
+        if self._thread is None:
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    async def stop(self):
+        if self._thread is not None:
+            # the sentinel must get through, even if the queue is full
+            await asyncio.get_event_loop().run_in_executor(None, self._queue.put, None)
+            await asyncio.get_event_loop().run_in_executor(None, self._thread.join)
+            self._thread = None
+            if self.dropped:
+                logger.info(f'Recorder dropped {self.dropped} frames')
+
+    def _put(self, track, frame):
+        if self._queue is None:
+            return
+        try:
+            # encoders on the live path may rebase the frame timestamps
+            self._queue.put_nowait((track, frame, frame.pts, frame.time_base))
+        except queue.Full:
+            self.dropped += 1
+
+    def _segment_path(self, name, index):
+        path, ext = os.path.splitext(self.path)
+        if name:
+            path = f'{path}_{name}'
+        # without segments, a replaced track still starts a new file
+        if self.segment_duration is not None or index:
+            path = f'{path}_{index:05d}'
+        return path + ext
+
+    def _run(self):
+        # tee name -> (current segment, segment index, track)
+        segments = {}
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            track, frame, pts, time_base = item
+            segment, index, segment_track = segments.get(track.name, (None, -1, None))
+            # a new track (e.g. after a reconnection) has new timestamps
+            if segment is not None and (segment.expired(self.segment_duration) or
+                                        segment_track is not track):
+                self._close(segment)
+                segment = None
+            if segment is None:
+                index += 1
+                segment = _Segment(self._segment_path(track.name, index), self.codec, self.fps)
+                self._add_segment(track.name, segment.path)
+                segments[track.name] = (segment, index, track)
+            try:
+                segment.write(frame, pts, time_base)
+            except Exception as err:
+                logger.error(f'Could not record frame: {err}')
+        for segment, _, _ in segments.values():
+            self._close(segment)
+
+    def _close(self, segment):
+        try:
+            segment.close()
+        except Exception as err:
+            logger.error(f'Could not close {segment.path}: {err}')
+
+    def _add_segment(self, name, path):
+        paths = self.segments.setdefault(name, [])
+        paths.append(path)
+        if self.max_segments and len(paths) > self.max_segments:
+            try:
+                os.remove(paths.pop(0))
+            except OSError:
+                pass
+
+
+class _Segment:
+    """One output file of a recorded track."""
+
+    def __init__(self, path, codec, fps):
+        self.path = path
+        self.start = time.monotonic()
+        self.container = av.open(path, mode='w')
+        self.stream = self.container.add_stream(codec, rate=fps)
+        self.stream.pix_fmt = 'yuv420p'
+        self.first_pts = None
+
+    def expired(self, duration):
+        return duration is not None and time.monotonic() - self.start >= duration
+
+    def write(self, frame, pts, time_base):
+        if self.first_pts is None:
+            self.stream.width = frame.width
+            self.stream.height = frame.height
+            # keep the source timestamps: frames arrive at a variable rate
+            self.stream.codec_context.time_base = time_base
+            # timestamps restart at 0 in every segment
+            self.first_pts = pts
+
+        # the resolution may change mid-segment, e.g. with output adaptation
+        out = frame.reformat(width=self.stream.width, height=self.stream.height, format='yuv420p')
+        if out is frame:
+            # the frame is shared with the live track, never modify it
+            out = av.VideoFrame.from_ndarray(frame.to_ndarray(), format='yuv420p')
+        out.pts = pts - self.first_pts
+        out.time_base = time_base
+        for packet in self.stream.encode(out):
+            self.container.mux(packet)
+
+    def close(self):
+        if self.first_pts is not None:
+            for packet in self.stream.encode(None):
+                self.container.mux(packet)
+        self.container.close()
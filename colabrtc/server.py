@@ -5,13 +5,31 @@ import uuid
 import os
 import glob
 import re
+from contextlib import contextmanager
 from datetime import datetime
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
 
 logger = logging.getLogger("colabrtc.server")
 
 
+def atomic_write(path, content):
+    """
+    Write to a temporary file and rename it into place, so readers never see
+    a partially written file. Temporary files start with a dot and are
+    therefore ignored by the message and peer glob patterns.
+    """
+    folder, filename = os.path.split(path)
+    tmp_path = os.path.join(folder, f'.{filename}.{uuid.uuid4().hex}.tmp')
+    with open(tmp_path, 'w') as tmp_file:
+        tmp_file.write(content)
+    os.replace(tmp_path, path)
+
+
 class Room():
     _folder_prefix = 'room'
 
@@ -67,6 +85,40 @@ class Room():
     def get_peer(self, peer_id):
         return self._peers.get(peer_id)
 
+    @contextmanager
+    def lock(self):
+        """
+        Exclusive inter-process lock on the room, used by writers (join and
+        send). Readers do not need it: they claim messages by renaming them.
+        """
+        os.makedirs(self._folder, exist_ok=True)
+        with open(os.path.join(self._folder, '.lock'), 'w') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                except OSError as err:
+                    # some network filesystems do not support locks
+                    logger.debug(f'Could not lock room {self._room_id}: {err}')
+            try:
+                yield self
+            finally:
+                if fcntl:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    except OSError:
+                        pass
+
+    def next_sequence(self):
+        """Allocate the next message sequence number. Must hold the room lock."""
+        sequence_file = os.path.join(self._folder, 'sequence')
+        sequence = 0
+        if os.path.exists(sequence_file):
+            with open(sequence_file, 'r') as seq_file:
+                sequence = int(seq_file.read() or 0)
+        sequence += 1
+        atomic_write(sequence_file, str(sequence))
+        return sequence
+
     def save(self):
         for message in self._messages:
             message.save()    
@@ -162,8 +214,7 @@ class Peer():
     def save(self):
         peer_data_file = os.path.join(self._folder, 'peer.json')
         if not os.path.exists(peer_data_file):
-            with open(peer_data_file, 'w') as json_file:
-                json.dump(self.to_json(), json_file)
+            atomic_write(peer_data_file, json.dumps(self.to_json()))
 
         for message in self._messages:
             message.save()
@@ -238,11 +289,40 @@ class Message():
         for message_folder in glob.glob(file_pattern):
             msg_id, msg_type, sender_id = Message.get_id_from_folder(message_folder)
             if msg_id:
-                message = Message(sender_id, message_id=msg_id, 
-                                  msg_type=msg_type).load(message_folder)
+                try:
+                    message = Message(sender_id, message_id=msg_id, 
+                                      msg_type=msg_type).load(message_folder)
+                except FileNotFoundError:
+                    # claimed (renamed) by a receiver in the meantime
+                    continue
                 messages.append(message)
         return messages
 
+    @staticmethod
+    def claim(folder, filename):
+        """
+        Mark an unread message file as read and return the message, or None
+        if another receiver claimed it first. The rename is atomic, so each
+        message is delivered exactly once without taking the room lock.
+        """
+        msg_id, msg_type, sender_id = Message.get_id_from_folder(filename)
+        message = Message(sender_id, message_id=msg_id, msg_type=msg_type)
+        message.is_read = True
+        read_file = os.path.join(folder, message._get_filename())
+        try:
+            os.rename(os.path.join(folder, filename), read_file)
+        except FileNotFoundError:
+            return None
+        return message.load(read_file)
+
+    @staticmethod
+    def sort_key(message_id):
+        # message ids are sequence numbers (or timestamps, for older rooms)
+        try:
+            return float(message_id)
+        except (TypeError, ValueError):
+            return float('inf')
+
     @property
     def message_id(self):
         return self._message_id
@@ -293,13 +373,28 @@ class Message():
             unread_file = message_file.replace(f'{Message._read_prefix}_', '')
             unread_file = os.path.join(folder, unread_file)
 
-            if os.path.exists(unread_file):
+            try:
                 os.rename(unread_file, message_file)
+            except FileNotFoundError:
+                pass
 
         if not os.path.exists(message_file):
-            with open(message_file, 'w') as txt_file:
-                txt_file.write(self.content)
+            atomic_write(message_file, self.content)
     
+    def copy_to(self, peer):
+        """
+        Copy an unread room message to a peer folder, unless a receiver
+        claims the room copy meanwhile. Returns whether it was copied.
+        """
+        self._save_to_folder(peer.folder)
+        if os.path.exists(os.path.join(self.room.folder, self._get_filename())):
+            return True
+        try:
+            os.remove(os.path.join(peer.folder, self._get_filename()))
+        except FileNotFoundError:
+            pass
+        return False
+
     def save(self):
         if self.room:
             self._save_to_folder(self.room.folder)
@@ -337,20 +432,25 @@ class FilesystemRTCServer:
         return peer
         
     def join(self, room_id):
-        room = self._get_room(room_id, create=True)
-        new_peer = Peer(room)
-        
-        relevant_messages = [msg for msg in room.messages if msg.msg_type in ['offer', 'candidate']]
-        if len(relevant_messages) == 0 or len(room.peers) == 0:
-            new_peer.is_initiator = True
-            
-        room.save()
-        
-        if relevant_messages:
-            logger.debug(f'> {len(room.messages)} messages in room {room_id}')
-        for message in relevant_messages:
-            message.peer = new_peer
-            message.save()
+        with Room(room_id, parent_folder=self._folder).lock():
+            room = self._get_room(room_id, create=True)
+            new_peer = Peer(room)
+
+            relevant_messages = [msg for msg in room.messages
+                                 if msg.msg_type in ['offer', 'candidate', 'candidates',
+                                                     'end-of-candidates']]
+            if len(relevant_messages) == 0 or len(room.peers) == 0:
+                new_peer.is_initiator = True
+
+            # only the new peer is written: receivers claim the files of the
+            # room and of the other peers without the lock, so rewriting them
+            # would bring claimed messages back
+            new_peer.save()
+
+            if relevant_messages:
+                logger.debug(f'> {len(room.messages)} messages in room {room_id}')
+            for message in sorted(relevant_messages, key=lambda m: Message.sort_key(m.message_id)):
+                message.copy_to(new_peer)
         
         params = {
             'messages': None,
@@ -364,45 +464,69 @@ class FilesystemRTCServer:
         return response
 
     def receive_message(self, room_id, peer_id):
-        try:
-            peer = self._get_peer(room_id, peer_id)
-            messages = peer.messages
-            if messages:
-                message = messages[0]
-                message.is_read = True
-                message.save()
-                return message.content
-        except ValueError as err:
-            return {'result': 'error', 'reason': str(err)}
+        messages = self.receive_messages(room_id, peer_id, max_messages=1)
+        if isinstance(messages, dict):
+            return messages
+        if messages:
+            return messages[0]
+
+    def receive_messages(self, room_id, peer_id, max_messages=None):
+        """
+        Pop pending messages for a peer, in sequence order. This only lists
+        the peer folder and does not load (or lock) the whole room.
+        """
+        room_folder = Room(room_id, parent_folder=self._folder).folder
+        peer_folder = os.path.join(room_folder, f'{Peer._folder_prefix}_{peer_id}')
+        if not os.path.isdir(peer_folder):
+            return {'result': 'error', 'reason': f'invalid peer id: {peer_id}'}
+
+        filenames = [f for f in os.listdir(peer_folder)
+                     if f.startswith(f'{Message._prefix}_') and Message.is_valid_filename(f)]
+        filenames.sort(key=lambda f: Message.sort_key(Message.get_id_from_folder(f)[0]))
+
+        contents = []
+        for filename in filenames:
+            message = Message.claim(peer_folder, filename)
+            if message is None:
+                continue
+            # also mark the room copy, so peers joining later skip it
+            Message.claim(room_folder, filename)
+            contents.append(message.content)
+            if max_messages and len(contents) >= max_messages:
+                break
+        return contents
 
     def send_message(self, room_id, peer_id, message_str):
         try:
-            room = self._get_room(room_id)
-            peer = room.get_peer(peer_id)
-            message = Message(sender_id=peer.peer_id, room=room, 
-                              content=message_str)
-            
-            message_json = json.loads(message_str)
-            if 'type' in message_json:
-                message.msg_type = message_json['type']
-            elif 'candidate' in message_json:
-                message.msg_type = 'candidate'
-                message_json['type'] = 'candidate'
-                message_json["id"] = message_json["sdpMid"]
-                message_json["label"] = message_json["sdpMLineIndex"]
-                message.content = json.dumps(message_json)
-                message.candidate = message_json['candidate']
-            else:
-                message.msg_type = 'other'
-                message_json['type'] = 'other'
-                message.content = json.dumps(message_json)
-
-            message.save()
-            for p_id, peer in room.peers.items():
-                if peer.peer_id == peer_id:
-                    continue
-                message.peer = peer
-                message.save()
-
+            with Room(room_id, parent_folder=self._folder).lock() as room:
+                self._send_message(room.load(), peer_id, message_str)
         except ValueError as err:
             return {'result': 'error', 'reason': str(err)}
+
+    def _send_message(self, room, peer_id, message_str):
+        peer = room.get_peer(peer_id)
+        message = Message(sender_id=peer.peer_id, room=room, 
+                          message_id=f'{room.next_sequence():012d}',
+                          content=message_str)
+        
+        message_json = json.loads(message_str)
+        if 'type' in message_json:
+            message.msg_type = message_json['type']
+        elif 'candidate' in message_json:
+            message.msg_type = 'candidate'
+            message_json['type'] = 'candidate'
+            message_json["id"] = message_json["sdpMid"]
+            message_json["label"] = message_json["sdpMLineIndex"]
+            message.content = json.dumps(message_json)
+            message.candidate = message_json['candidate']
+        else:
+            message.msg_type = 'other'
+            message_json['type'] = 'other'
+            message.content = json.dumps(message_json)
+
+        message.save()
+        for p_id, peer in room.peers.items():
+            if peer.peer_id == peer_id:
+                continue
+            message.peer = peer
+            message.save()
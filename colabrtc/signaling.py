@@ -1,144 +1,121 @@
 import json
 import logging
 import random
-import IPython
+import time
 import asyncio
 
 from aiortc import RTCIceCandidate, RTCSessionDescription
-from aiortc.contrib.signaling import object_from_string, object_to_string, BYE
-from aiortc.contrib.signaling import ApprtcSignaling
+from aiortc.sdp import candidate_from_sdp, candidate_to_sdp
 
 from server import FilesystemRTCServer
 
-try:
-    import aiohttp
-    import websockets
-except ImportError:  # pragma: no cover
-    aiohttp = None
-    websockets = None
-
 logger = logging.getLogger("colabrtc.signaling")
 
-try:
-    from google.colab import output
-except ImportError:
-    output = None
-    logger.info('google.colab not available')
-    
+# Long-poll defaults for Python peers: a receive call waits for at most
+# POLL_TIMEOUT seconds, checking for new messages every POLL_INTERVAL seconds.
+# Javascript callbacks never wait, they would block the kernel (see
+# receive_batch_sync).
+POLL_TIMEOUT = 0.5
+POLL_INTERVAL = 0.02
+
+# Same wire format as aiortc.contrib.signaling, which is not imported here
+# because it loads aiohttp and websockets (only needed for AppRTC).
+BYE = object()
+# Sent once a peer has no more ICE candidates to trickle, so the other side
+# knows candidate exchange is over.
+END_OF_CANDIDATES = object()
+# Asks the other peer to replace its peer connection (and is sent before the
+# new offer), so a dropped call reconnects without tearing down the peers.
+RESTART = object()
+
+
+def _candidate_from_json(message):
+    candidate = candidate_from_sdp(message["candidate"].split(":", 1)[1])
+    candidate.sdpMid = message.get("id", message.get("sdpMid"))
+    candidate.sdpMLineIndex = message.get("label", message.get("sdpMLineIndex"))
+    return candidate
+
+
+def _candidate_to_json(candidate):
+    return {
+        "candidate": "candidate:" + candidate_to_sdp(candidate),
+        "id": candidate.sdpMid,
+        "label": candidate.sdpMLineIndex,
+    }
+
+
+def object_from_string(message_str):
+    """
+    Parse a signaling message. Besides the aiortc message types, a batch of
+    candidates ("candidates") is parsed to a list of `RTCIceCandidate`, and
+    "end-of-candidates" to `END_OF_CANDIDATES` and "restart" to `RESTART`.
+    """
+    message = json.loads(message_str)
+    if message["type"] in ["answer", "offer"]:
+        return RTCSessionDescription(**message)
+    elif message["type"] == "candidate" and message["candidate"]:
+        return _candidate_from_json(message)
+    elif message["type"] == "candidates":
+        return [_candidate_from_json(c) for c in message["candidates"] if c.get("candidate")]
+    elif message["type"] == "end-of-candidates":
+        return END_OF_CANDIDATES
+    elif message["type"] == "restart":
+        return RESTART
+    elif message["type"] == "bye":
+        return BYE
+
+
+def object_to_string(obj):
+    if isinstance(obj, RTCSessionDescription):
+        message = {"sdp": obj.sdp, "type": obj.type}
+    elif isinstance(obj, RTCIceCandidate):
+        message = _candidate_to_json(obj)
+        message["type"] = "candidate"
+    elif isinstance(obj, list):
+        message = {
+            "candidates": [_candidate_to_json(c) for c in obj],
+            "type": "candidates",
+        }
+    elif obj is END_OF_CANDIDATES:
+        message = {"type": "end-of-candidates"}
+    elif obj is RESTART:
+        message = {"type": "restart"}
+    else:
+        assert obj is BYE
+        message = {"type": "bye"}
+    return json.dumps(message, sort_keys=True)
+
+
+_output = None
+
+
+def colab_output():
+    """
+    Return the `google.colab.output` module, imported on first use, or None
+    when not running on Colab.
+    """
+    global _output
+    if _output is None:
+        try:
+            from google.colab import output as _output
+        except ImportError:
+            _output = False
+            logger.info('google.colab not available')
+    return _output or None
 
-class ColabApprtcSignaling(ApprtcSignaling):
-    def __init__(self, room=None, javacript_callable=False):
-        super().__init__(room)
 
-        self._javascript_callable = javacript_callable
+def register_callbacks(signaling, room):
+    output = colab_output()
+    if output:
+        for action in ['connect', 'send', 'receive', 'receive_batch', 'close']:
+            output.register_callback(f'{room}.colab.signaling.{action}',
+                                     getattr(signaling, f'{action}_sync'))
 
-        if output and javacript_callable:
-            output.register_callback(f'{room}.colab.signaling.connect', self.connect_sync)
-            output.register_callback(f'{room}.colab.signaling.send', self.send_sync)
-            output.register_callback(f'{room}.colab.signaling.receive', self.receive_sync)
-            output.register_callback(f'{room}.colab.signaling.close', self.close_sync)
-            
-    @property
-    def room(self):
-        return self._room
 
-    async def connect(self):
-        join_url = self._origin + "/join/" + self._room
-
-        # fetch room parameters
-        self._http = aiohttp.ClientSession()
-        async with self._http.post(join_url) as response:
-            # we cannot use response.json() due to:
-            # https://github.com/webrtc/apprtc/issues/562
-            data = json.loads(await response.text())
-        assert data["result"] == "SUCCESS"
-        params = data["params"]
-
-        self.__is_initiator = params["is_initiator"] == "true"
-        self.__messages = params["messages"]
-        self.__post_url = (
-            self._origin + "/message/" + self._room + "/" + params["client_id"]
-        )
-
-        # connect to websocket
-        self._websocket = await websockets.connect(
-            params["wss_url"], extra_headers={"Origin": self._origin}
-        )
-        await self._websocket.send(
-            json.dumps(
-                {
-                    "clientid": params["client_id"],
-                    "cmd": "register",
-                    "roomid": params["room_id"],
-                }
-            )
-        )
-
-        print(f"AppRTC room is {params['room_id']} {params['room_link']}")
+def to_javascript(data):
+    from IPython.display import JSON
+    return JSON(data)
 
-        return params
-            
-    def connect_sync(self):
-        loop = asyncio.get_event_loop()
-        result = loop.run_until_complete(self.connect())
-        if self._javascript_callable:
-            return IPython.display.JSON(result)
-        return result
-            
-    def close_sync(self):
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(self.close())
-    
-    def recv_nowait(self):
-        try:
-            return self._websocket.messages.popleft() # .get_nowait()
-        #except (asyncio.queues.QueueEmpty, IndexError):
-        except IndexError:
-            pass
-        
-    async def receive(self):
-        if self.__messages:
-            message = self.__messages.pop(0)
-        else:
-            message = self.recv_nowait()
-            if message:
-                message = json.loads(message)["msg"]
-        
-        if message:
-            logger.debug("< " + message)
-            return object_from_string(message)
-    
-    def receive_sync(self):
-        loop = asyncio.get_event_loop()
-        message = loop.run_until_complete(self.receive())
-        if message and self._javascript_callable:
-            message = object_to_string(message)
-            print('receive:', message)
-            message = json.loads(message)
-            message = IPython.display.JSON(message)
-        return message
-    
-    async def send(self, obj):
-        message = object_to_string(obj)
-        logger.debug("> " + message)
-        if self.__is_initiator:
-            await self._http.post(self.__post_url, data=message)
-        else:
-            await self._websocket.send(json.dumps({"cmd": "send", "msg": message}))
-        
-    def send_sync(self, message):
-        print('send:', message)
-        if type(message) == str:
-            message_json = json.loads(message)
-            if 'candidate' in message_json:
-                message_json['type'] = 'candidate'
-                message_json["id"] = message_json["sdpMid"]
-                message_json["label"] = message_json["sdpMLineIndex"]
-                message = json.dumps(message_json)  
-                message = object_from_string(message)
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(self.send(message))
-    
 
 class ColabSignaling:
     def __init__(self, signaling_folder=None, webrtc_server=None, room=None, javacript_callable=False):
@@ -155,11 +132,8 @@ class ColabSignaling:
         self._room = room
         self._javascript_callable = javacript_callable
 
-        if output and javacript_callable:
-            output.register_callback(f'{room}.colab.signaling.connect', self.connect_sync)
-            output.register_callback(f'{room}.colab.signaling.send', self.send_sync)
-            output.register_callback(f'{room}.colab.signaling.receive', self.receive_sync)
-            output.register_callback(f'{room}.colab.signaling.close', self.close_sync)
+        if javacript_callable:
+            register_callbacks(self, room)
 
     @property
     def room(self):
@@ -182,7 +156,7 @@ class ColabSignaling:
         loop = asyncio.get_event_loop()
         result = loop.run_until_complete(self.connect())
         if self._javascript_callable:
-            return IPython.display.JSON(result)
+            return to_javascript(result)
         return result
             
     async def close(self):
@@ -195,29 +169,85 @@ class ColabSignaling:
         loop = asyncio.get_event_loop()
         return loop.run_until_complete(self.close())
     
-    async def receive(self):
+    def _parse(self, message):
+        if message and type(message) == str and not self._javascript_callable:
+            message = object_from_string(message)
+        return message
+
+    def _receive_batch(self, timeout=0, max_messages=None):
+        deadline = time.monotonic() + timeout
+        while True:
+            messages = self._webrtc_server.receive_messages(self._room, self.__peer_id,
+                                                            max_messages=max_messages)
+            if isinstance(messages, dict):
+                # e.g. the room folder was deleted
+                logger.error(f'Could not receive messages: {messages.get("reason")}')
+                return []
+            if messages or time.monotonic() >= deadline:
+                return messages or []
+            time.sleep(POLL_INTERVAL)
+
+    def _receive(self):
         message = self._webrtc_server.receive_message(self._room, self.__peer_id)
+        if isinstance(message, dict):
+            logger.error(f'Could not receive message: {message.get("reason")}')
+            return None
+        return message
+
+    async def receive(self):
+        message = self._receive()
         # if self._javascript_callable:
         #     print('ColabSignaling: sending message to Javascript peer:', message)
         # else:
         #     print('ColabSignaling: sending message to Python peer:', message)
-        if message and type(message) == str and not self._javascript_callable:
-            message = object_from_string(message)
-        return message
+        return self._parse(message)
 
     def receive_sync(self):
-        loop = asyncio.get_event_loop()
-        message = loop.run_until_complete(self.receive())
+        # The filesystem server is synchronous, so there is no need to spin
+        # the (nested) event loop for every Javascript callback.
+        message = self._parse(self._receive())
         if message and self._javascript_callable:
             message = json.loads(message)
-            message = IPython.display.JSON(message)
+            message = to_javascript(message)
         return message
-        
+
+    async def receive_batch(self, timeout=POLL_TIMEOUT, max_messages=None):
+        deadline = time.monotonic() + timeout
+        while True:
+            messages = self._receive_batch(max_messages=max_messages)
+            if messages or time.monotonic() >= deadline:
+                return [self._parse(m) for m in messages]
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def receive_batch_sync(self, timeout=0, max_messages=None):
+        """
+        Return every pending message, waiting up to `timeout` seconds for one.
+        Javascript callbacks run on the kernel thread, one at a time, so the
+        page calls this with no timeout: a waiting receive would delay its
+        sends (see `SignalingChannel` in js/signaling.js).
+        """
+        messages = [self._parse(m) for m in self._receive_batch(timeout, max_messages)]
+        if self._javascript_callable:
+            messages = [json.loads(m) for m in messages]
+            return to_javascript(messages)
+        return messages
+
     async def send(self, message):
+        self._send(message)
+
+    def _send(self, message):
         if not self._javascript_callable or type(message) != str:
             message = object_to_string(message)
         self._webrtc_server.send_message(self._room, self.__peer_id, message)
-        
+
     def send_sync(self, message):
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(self.send(message))
+        return self._send(message)
+
+
+def __getattr__(name):
+    # AppRTC signaling depends on aiohttp and websockets, so it is only
+    # imported when requested
+    if name == 'ColabApprtcSignaling':
+        from apprtc import ColabApprtcSignaling
+        return ColabApprtcSignaling
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,147 @@
+import asyncio
+import collections
+import json
+import logging
+import time
+
+logger = logging.getLogger("colabrtc.stats")
+
+# RTP clock rates, to convert jitter from timestamp units to seconds
+CLOCK_RATES = {'audio': 48000, 'video': 90000}
+
+
+class JsonLinesSink:
+    """Appends each stats sample to `path`, one JSON object per line."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+
+    def write(self, sample):
+        self._file.write(json.dumps(sample) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class RingBufferSink:
+    """Keeps the last `size` stats samples in memory."""
+
+    def __init__(self, size=600):
+        self.samples = collections.deque(maxlen=size)
+
+    @property
+    def latest(self):
+        return self.samples[-1] if self.samples else None
+
+    def write(self, sample):
+        self.samples.append(sample)
+
+    def close(self):
+        pass
+
+
+class StatsCollector:
+    """
+    Samples `RTCPeerConnection.getStats()` every `interval` seconds and
+    writes derived rates to `sinks` (objects with `write(sample)` and
+    `close()`), which are only closed by `close()`. aiortc does not report
+    frame counts, so frame rates and dropped frames are read from the
+    `frames_received`, `frames_sent` and `frames_dropped` counters of the
+    given `tracks`, when they have them, and so is the frame allocation
+    rate (`bytes_allocated`).
+    """
+
+    def __init__(self, pc, sinks, tracks=(), interval=1., label=None):
+        self.pc = pc
+        self.sinks = list(sinks)
+        self.tracks = list(tracks)
+        self.interval = interval
+        self.label = label
+        self._last = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def stop(self):
+        """Stop sampling. The sinks stay open, e.g. for the next connection."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def close(self):
+        """Stop sampling and close the sinks."""
+        self.stop()
+        for sink in self.sinks:
+            sink.close()
+
+    async def _run(self):
+        while self.pc.signalingState != 'closed':
+            await asyncio.sleep(self.interval)
+            try:
+                sample = self.sample(await self.pc.getStats())
+            except Exception as err:
+                logger.debug(f'Could not collect stats: {err}')
+                continue
+            if sample is not None:
+                for sink in self.sinks:
+                    sink.write(sample)
+
+    def _counters(self, report):
+        counters = collections.Counter()
+        for stats in report.values():
+            if stats.type == 'outbound-rtp':
+                counters['bytes_sent'] += stats.bytesSent
+                counters['packets_sent'] += stats.packetsSent
+            elif stats.type == 'inbound-rtp':
+                counters['packets_received'] += stats.packetsReceived
+                counters['packets_lost'] += stats.packetsLost
+            elif stats.type == 'transport':
+                # inbound RTP stats have no byte count, use the transport's
+                counters['bytes_received'] += stats.bytesReceived
+        for track in self.tracks:
+            for name in ['frames_received', 'frames_sent', 'frames_dropped', 'bytes_allocated']:
+                counters[name] += getattr(track, name, 0)
+        return counters
+
+    def sample(self, report):
+        """Derive a stats sample from a stats report, or None for the first one."""
+        now = time.time()
+        counters = self._counters(report)
+        last = self._last
+        self._last = (now, counters)
+        if last is None:
+            return None
+
+        elapsed = now - last[0]
+        delta = counters - last[1]
+        sample = {
+            'time': now,
+            'label': self.label,
+            'fps_sent': delta['frames_sent'] / elapsed,
+            'fps_received': delta['frames_received'] / elapsed,
+            'bitrate_sent': delta['bytes_sent'] * 8 / elapsed,
+            'bitrate_received': delta['bytes_received'] * 8 / elapsed,
+            'frames_dropped': counters['frames_dropped'],
+            'alloc_rate': delta['bytes_allocated'] / elapsed,
+            'packets_lost': counters['packets_lost'],
+            'packet_loss': None,
+            'jitter': None,
+            'rtt': None,
+        }
+
+        # the receive side loss since the last sample
+        expected = delta['packets_received'] + delta['packets_lost']
+        if expected:
+            sample['packet_loss'] = delta['packets_lost'] / expected
+
+        for stats in report.values():
+            if stats.type == 'inbound-rtp' and stats.kind == 'video':
+                sample['jitter'] = stats.jitter / CLOCK_RATES['video']
+            elif stats.type == 'remote-inbound-rtp' and stats.kind == 'video':
+                sample['rtt'] = stats.roundTripTime
+        return sample
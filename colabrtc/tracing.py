@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+import time
+
+logger = logging.getLogger("colabrtc.tracing")
+
+
+class TraceRecorder:
+    """
+    Wraps a signaling server (e.g. `FilesystemRTCServer`) and appends each
+    join, send and receive to `path`, one JSON object per line with its
+    wall clock time, room and peer id. The file is opened for every event,
+    so the recorder can be pickled into peer processes, and several peers
+    (or rooms) can share a trace.
+    """
+
+    def __init__(self, server, path):
+        self.server = server
+        self.path = path
+
+    def _write(self, op, room_id, peer_id, **data):
+        event = dict(time=time.time(), op=op, room=room_id, peer=peer_id, **data)
+        with open(self.path, 'a') as trace_file:
+            trace_file.write(json.dumps(event) + '\n')
+
+    def join(self, room_id):
+        response = self.server.join(room_id)
+        params = response.get('params') or {}
+        self._write('join', room_id, params.get('peer_id'), params=params)
+        return response
+
+    def receive_message(self, room_id, peer_id):
+        messages = self.receive_messages(room_id, peer_id, max_messages=1)
+        if isinstance(messages, dict):
+            return messages
+        if messages:
+            return messages[0]
+
+    def receive_messages(self, room_id, peer_id, max_messages=None):
+        messages = self.server.receive_messages(room_id, peer_id, max_messages=max_messages)
+        # empty polls are not recorded
+        if isinstance(messages, list):
+            for message in messages:
+                self._write('receive', room_id, peer_id, message=message)
+        return messages
+
+    def send_message(self, room_id, peer_id, message_str):
+        self._write('send', room_id, peer_id, message=message_str)
+        return self.server.send_message(room_id, peer_id, message_str)
+
+
+def load_trace(path, room=None, peer=None):
+    """
+    Read the events of one peer from a trace: the peer `peer` of `room`, or
+    the first peer that joined (`room`, if given). Event times are made
+    relative to the join.
+    """
+    with open(path) as trace_file:
+        events = [json.loads(line) for line in trace_file if line.strip()]
+
+    join = next((e for e in events if e['op'] == 'join' and
+                 (room is None or e['room'] == room) and
+                 (peer is None or e['peer'] == peer)), None)
+    if join is None:
+        raise ValueError(f'No peer {peer or ""} joined room {room or ""} in {path}')
+
+    events = [dict(e, time=e['time'] - join['time']) for e in events
+              if e['room'] == join['room'] and e['peer'] == join['peer']]
+    return events
+
+
+class TraceReplayServer:
+    """
+    Stands in for the signaling server of a recorded peer, so `ColabSignaling`
+    and `run()` can be driven from a trace (see `TraceRecorder`): `join`
+    returns the recorded peer, and each recorded message is received once its
+    time (divided by `speed`) has elapsed since the join, and once the live
+    peer has sent as many messages as the recorded one had at that point, so
+    accelerated replays keep the order of the exchange. `speed=None` replays
+    as fast as the live peer answers.
+
+    The remote peer of the trace is gone, so ICE does not complete: replays
+    measure how the peer handles signaling (negotiation, candidates, restarts
+    and hang-up), see `timeline`.
+    """
+
+    def __init__(self, path, room=None, peer=None, speed=1.):
+        self.speed = speed
+        events = load_trace(path, room=room, peer=peer)
+        self._join = events[0]
+        self._receives = []
+        self._sends = []
+        for event in events[1:]:
+            if event['op'] == 'receive':
+                # messages the recorded peer had sent before receiving this one
+                self._receives.append((event['time'], len(self._sends), event['message']))
+            elif event['op'] == 'send':
+                self._sends.append((event['time'], event['message']))
+        self.sent = []
+        self._start = None
+
+    @property
+    def room(self):
+        return self._join['room']
+
+    @property
+    def pending(self):
+        """The number of recorded messages not received yet."""
+        return len(self._receives)
+
+    def _now(self):
+        return time.monotonic() - self._start
+
+    def join(self, room_id):
+        self._start = time.monotonic()
+        return {'result': 'SUCCESS', 'params': dict(self._join['params'], messages=None)}
+
+    def receive_message(self, room_id, peer_id):
+        messages = self.receive_messages(room_id, peer_id, max_messages=1)
+        if messages:
+            return messages[0]
+
+    def receive_messages(self, room_id, peer_id, max_messages=None):
+        messages = []
+        while self._receives and not (max_messages and len(messages) >= max_messages):
+            offset, sends, message = self._receives[0]
+            if self.speed and self._now() < offset / self.speed:
+                break
+            if len(self.sent) < sends:
+                break
+            self._receives.pop(0)
+            messages.append(message)
+        return messages
+
+    def send_message(self, room_id, peer_id, message_str):
+        self.sent.append((self._now(), message_str))
+
+    @property
+    def timeline(self):
+        """
+        The messages sent by the live peer next to the recorded ones, in
+        order: (message type, recorded time, replay time), with the replay
+        time scaled back by `speed` to compare with the recording.
+        """
+        scale = self.speed or 1.
+        timeline = []
+        for index in range(max(len(self._sends), len(self.sent))):
+            recorded = self._sends[index] if index < len(self._sends) else None
+            replayed = self.sent[index] if index < len(self.sent) else None
+            message = (replayed or recorded)[1]
+            timeline.append((_message_type(message),
+                             recorded[0] if recorded else None,
+                             replayed[0] * scale if replayed else None))
+        return timeline
+
+
+def _message_type(message):
+    try:
+        message = json.loads(message)
+    except ValueError:
+        return None
+    if isinstance(message, list) or 'candidates' in message:
+        return 'candidates'
+    return message.get('type', 'candidate' if 'candidate' in message else None)
+
+
+def replay(trace_file, room=None, peer=None, speed=1., play_from=None, frame_transformer=None,
+           timeout=60., verbose=False):
+    """
+    Run a Python peer against the recorded signaling of `room` (or its first
+    peer) in `trace_file`, at `speed` times the original pace, and print
+    when each message was sent, compared with the recording.
+    """
+    # the peer module is heavy, and only needed to replay
+    from signaling import ColabSignaling
+    from peer import _setup_logging, create_peer_connection, create_media, run
+
+    _setup_logging(verbose)
+    server = TraceReplayServer(trace_file, room=room, peer=peer, speed=speed)
+    signaling = ColabSignaling(webrtc_server=server, room=server.room)
+
+    async def replay_peer():
+        pc = create_peer_connection()
+        player, recorder = create_media(play_from)
+        try:
+            await asyncio.wait_for(
+                run(pc, player, recorder, signaling, frame_transformer=frame_transformer,
+                    create_pc=create_peer_connection), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'Replay timed out, {server.pending} messages not received')
+        finally:
+            await recorder.stop()
+            await pc.close()
+
+    asyncio.get_event_loop().run_until_complete(replay_peer())
+    for msg_type, recorded, replayed in server.timeline:
+        recorded = f'{recorded:8.3f}s' if recorded is not None else '        -'
+        replayed = f'{replayed:8.3f}s' if replayed is not None else '        -'
+        print(f'{str(msg_type):20} recorded {recorded}  replayed {replayed}')
+    return server.timeline
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(replay)
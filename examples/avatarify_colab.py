@@ -1,6 +1,8 @@
 import os
 import glob
+import hashlib
 import time
+import uuid
 
 import imageio
 import numpy as np
@@ -22,36 +24,53 @@ from cam_fomm import (load_checkpoints, normalize_alignment_kp,
 
 import face_alignment
 
-from peer import FrameTransformer
+from peer import FrameTransformer, FrameTransformerSession
+from buffers import FramePoolExhausted
 from call import ColabCall
 
 
-def predict(driving_frame, source_image, relative, adapt_movement_scale, fa,
-            generator, kp_detector, kp_driving_initial, device='cuda'):
-    global start_frame
-    global start_frame_kp
-    # global kp_driving_initial
+def predict(driving_frame, avatar_state, relative, adapt_movement_scale,
+            generator, kp_detector, kp_driving_initial, device='cuda', buffers=None):
+    source = avatar_state['source']
+    kp_source = avatar_state['kp_source']
 
     with torch.no_grad():
-        source = torch.tensor(source_image[np.newaxis].astype(np.float32)).permute(0, 3, 1, 2).to(device)
-        driving = torch.tensor(driving_frame[np.newaxis].astype(np.float32)).permute(0, 3, 1, 2).to(device)
-        kp_source = kp_detector(source)
+        if buffers is not None:
+            driving = buffers.set_driving(driving_frame)
+        else:
+            driving = torch.tensor(driving_frame[np.newaxis].astype(np.float32)).permute(0, 3, 1, 2).to(device)
+        kp_driving = kp_detector(driving)
 
         if kp_driving_initial is None:
-            kp_driving_initial = kp_detector(driving)
-            start_frame = driving_frame.copy()
-            start_frame_kp = get_frame_kp(fa, driving_frame)
+            kp_driving_initial = kp_driving
 
-        kp_driving = kp_detector(driving)
         kp_norm = normalize_kp(kp_source=kp_source, kp_driving=kp_driving,
                                kp_driving_initial=kp_driving_initial, use_relative_movement=relative,
                                use_relative_jacobian=relative, adapt_movement_scale=adapt_movement_scale)
         out = generator(source, kp_source=kp_source, kp_driving=kp_norm)
 
+        if buffers is not None:
+            # note: the returned array is overwritten by the next call
+            return buffers.set_output(out['prediction']), kp_driving_initial
+
         out = np.transpose(out['prediction'].data.cpu().numpy(), [0, 2, 3, 1])[0]
         out = (np.clip(out, 0, 1) * 255).astype(np.uint8)
 
-        return out
+        return out, kp_driving_initial
+
+
+def prepare_avatar(avatar, fa, kp_detector, device='cuda', avatar_kp=None):
+    """
+    Compute everything that depends only on the avatar (source tensor,
+    source keypoints and landmarks), so it is done once per avatar instead
+    of once per frame.
+    """
+    with torch.no_grad():
+        source = torch.tensor(avatar[np.newaxis].astype(np.float32)).permute(0, 3, 1, 2).to(device)
+        kp_source = kp_detector(source)
+    if avatar_kp is None:
+        avatar_kp = get_frame_kp(fa, avatar)
+    return {'avatar': avatar, 'source': source, 'kp_source': kp_source, 'avatar_kp': avatar_kp}
 
 
 def change_avatar(fa, new_avatar):
@@ -61,31 +80,115 @@ def change_avatar(fa, new_avatar):
     return avatar, avatar_kp
 
 
-def load_avatars(avatars_dir='./avatarify/avatars'):
-    avatars = []
-    images_list = sorted(glob.glob(f'{avatars_dir}/*'))
-    for i, f in enumerate(images_list):
-        if f.endswith('.jpg') or f.endswith('.jpeg') or f.endswith('.png'):
-            log(f'{i}: {f}')
-            img = imageio.imread(f)
-            if img.ndim == 2:
-                img = np.tile(img[..., None], [1, 1, 3])
-            img = resize(img, (256, 256))[..., :3]
-            avatars.append(img)
-    return avatars
-
-
-def generate_fake_frame(frame, avatar, generator, kp_detector, relative=False, adapt_scale=True,
+def preprocess_avatar(path):
+    img = imageio.imread(path)
+    if img.ndim == 2:
+        img = np.tile(img[..., None], [1, 1, 3])
+    img = resize(img, (256, 256))[..., :3]
+    return (img * 255).round().astype(np.uint8)
+
+
+class AvatarCache:
+    """
+    Lazily loaded avatars. Each image is preprocessed once to 256x256 uint8
+    and stored, with its landmarks, as .npy files keyed by path and mtime.
+    Cached files are memory-mapped, so only avatars in use take up memory.
+    """
+
+    def __init__(self, avatars_dir='./avatarify/avatars', cache_dir=None):
+        self.cache_dir = cache_dir or os.path.join(avatars_dir, '.cache')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.paths = []
+        images_list = sorted(glob.glob(f'{avatars_dir}/*'))
+        for i, f in enumerate(images_list):
+            if f.endswith('.jpg') or f.endswith('.jpeg') or f.endswith('.png'):
+                log(f'{i}: {f}')
+                self.paths.append(f)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        # float32 in [0, 1], as expected by the models
+        return self.image(index).astype(np.float32) / 255
+
+    def _cache_file(self, index, suffix):
+        path = os.path.abspath(self.paths[index])
+        key = hashlib.sha1(f'{path}:{os.path.getmtime(path)}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{key}_{suffix}.npy')
+
+    def _save(self, cache_file, array):
+        tmp_file = f'{cache_file}.{uuid.uuid4().hex}.tmp.npy'
+        np.save(tmp_file, array)
+        os.replace(tmp_file, cache_file)
+
+    def image(self, index):
+        cache_file = self._cache_file(index, 'image')
+        if not os.path.exists(cache_file):
+            self._save(cache_file, preprocess_avatar(self.paths[index]))
+        return np.load(cache_file, mmap_mode='r')
+
+    def landmarks(self, index, fa):
+        cache_file = self._cache_file(index, 'landmarks')
+        if os.path.exists(cache_file):
+            return np.load(cache_file)
+        avatar_kp = get_frame_kp(fa, self[index])
+        if avatar_kp is not None:
+            self._save(cache_file, np.asarray(avatar_kp, dtype=np.float32))
+        return avatar_kp
+
+
+def load_avatars(avatars_dir='./avatarify/avatars', cache_dir=None):
+    return AvatarCache(avatars_dir, cache_dir=cache_dir)
+
+
+def crop_center(img, size):
+    h, w = img.shape[:2]
+    u = (h - size) // 2
+    l = (w - size) // 2
+    return img[u:u + size, l:l + size]
+
+
+def pad_to_aspect(img, orig, buffer=None):
+    # like pad_img, but the resize is left to the video track. `buffer(shape,
+    # dtype)` returns the output array, e.g. FrameTransformerSession.buffer
+    h, w = orig.shape[:2]
+    pad = int(img.shape[0] * (w / h) - img.shape[1])
+    if pad <= 0:
+        return img
+    if buffer is None:
+        return np.pad(img, [[0, 0], [pad // 2, pad // 2], [0, 0]], 'constant')
+    left = pad // 2
+    out = buffer((img.shape[0], img.shape[1] + 2 * left, img.shape[2]), img.dtype)
+    out[:, :left] = 0
+    out[:, left + img.shape[1]:] = 0
+    out[:, left:left + img.shape[1]] = img
+    return out
+
+
+def load_face_alignment(device='cuda'):
+    return face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, flip_input=True, device=device)
+
+
+def generate_fake_frame(frame, avatar_state, generator, kp_detector, fa, relative=False, adapt_scale=True,
                         no_pad=False, verbose=False, device='cuda',
                         passthrough=False, kp_driving_initial=None,
-                        show_fps=False):
-    fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, flip_input=True, device=device)
-    avatar, avatar_kp = change_avatar(fa, avatar)
+                        show_fps=False, display_string='', frame_proportion=0.9,
+                        prescaled=False, buffers=None, output_flip=False, buffer=None,
+                        preview=True):
+    """
+    If `prescaled`, `frame` is an RGB uint8 frame already scaled so that its
+    center crop is 256x256 (see `Avatarify.input_size`), and the output is
+    padded to the frame aspect ratio without being resized.
+
+    With `buffer(shape, dtype)`, the output is written to the returned
+    arrays instead of new ones. Without `preview`, no preview frame is made
+    (None is returned instead).
+    """
+    avatar = avatar_state['avatar']
 
-    frame_proportion = 0.9
     overlay_alpha = 0.0
     preview_flip = False
-    output_flip = False
     find_keyframe = False
 
     fps_hist = []
@@ -94,10 +197,14 @@ def generate_fake_frame(frame, avatar, generator, kp_detector, relative=False, a
     t_start = time.time()
 
     green_overlay = False
-    frame_orig = frame.copy()
 
-    frame, lrud = crop(frame, p=frame_proportion)
-    frame = resize(frame, (256, 256))[..., :3]
+    if prescaled:
+        frame_orig = frame
+        frame = crop_center(frame, 256).astype(np.float32) / 255
+    else:
+        frame_orig = frame.copy()
+        frame, lrud = crop(frame, p=frame_proportion)
+        frame = resize(frame, (256, 256))[..., :3]
 
     if find_keyframe:
         if is_new_frame_better(fa, avatar, frame, device):
@@ -110,11 +217,12 @@ def generate_fake_frame(frame, avatar, generator, kp_detector, relative=False, a
         log(f'PREPROC: {preproc_time:.3f}ms')
 
     if passthrough:
-        out = frame_orig[..., ::-1]
+        out = frame_orig if prescaled else frame_orig[..., ::-1]
     else:
         pred_start = time.time()
-        pred = predict(frame, avatar, relative, adapt_scale, fa, generator, kp_detector, kp_driving_initial,
-                       device=device)
+        pred, kp_driving_initial = predict(frame, avatar_state, relative, adapt_scale, generator,
+                                           kp_detector, kp_driving_initial, device=device,
+                                           buffers=buffers)
         out = pred
         pred_time = (time.time() - pred_start) * 1000
         if verbose:
@@ -122,7 +230,9 @@ def generate_fake_frame(frame, avatar, generator, kp_detector, relative=False, a
 
     postproc_start = time.time()
 
-    if not no_pad:
+    if not no_pad and prescaled:
+        out = pad_to_aspect(out, frame_orig, buffer=buffer)
+    elif not no_pad:
         out = pad_img(out, frame_orig)
 
     if out.dtype != np.uint8:
@@ -161,27 +271,31 @@ def generate_fake_frame(frame, avatar, generator, kp_detector, relative=False, a
     # elif key != -1:
     #     log(key)
 
-    preview_frame = cv2.addWeighted(avatar[:, :, ::-1], overlay_alpha, frame, 1.0 - overlay_alpha, 0.0)
+    if output_flip:
+        flipped = buffer(out.shape, out.dtype) if buffer is not None else None
+        out = cv2.flip(out, 1, dst=flipped)
 
-    if preview_flip:
-        preview_frame = cv2.flip(preview_frame, 1)
+    preview_frame = None
+    if preview:
+        preview_frame = cv2.addWeighted(avatar[:, :, ::-1].astype(frame.dtype), overlay_alpha,
+                                        frame, 1.0 - overlay_alpha, 0.0)
 
-    if output_flip:
-        out = cv2.flip(out, 1)
+        if preview_flip:
+            preview_frame = cv2.flip(preview_frame, 1)
 
-    if green_overlay:
-        green_alpha = 0.8
-        overlay = preview_frame.copy()
-        overlay[:] = (0, 255, 0)
-        preview_frame = cv2.addWeighted(preview_frame, green_alpha, overlay, 1.0 - green_alpha, 0.0)
+        if green_overlay:
+            green_alpha = 0.8
+            overlay = preview_frame.copy()
+            overlay[:] = (0, 255, 0)
+            preview_frame = cv2.addWeighted(preview_frame, green_alpha, overlay, 1.0 - green_alpha, 0.0)
 
-    if find_keyframe:
-        preview_frame = cv2.putText(preview_frame, display_string, (10, 220), 0, 0.5, (255, 255, 255), 1)
+        if find_keyframe:
+            preview_frame = cv2.putText(preview_frame, display_string, (10, 220), 0, 0.5, (255, 255, 255), 1)
 
-    if show_fps:
-        fps_string = f'FPS: {fps:.2f}'
-        preview_frame = cv2.putText(preview_frame, fps_string, (10, 240), 0, 0.5, (255, 255, 255), 1)
-        frame = cv2.putText(frame, fps_string, (10, 240), 0, 0.5, (255, 255, 255), 1)
+        if show_fps:
+            fps_string = f'FPS: {fps:.2f}'
+            preview_frame = cv2.putText(preview_frame, fps_string, (10, 240), 0, 0.5, (255, 255, 255), 1)
+            frame = cv2.putText(frame, fps_string, (10, 240), 0, 0.5, (255, 255, 255), 1)
 
     if verbose:
         postproc_time = (time.time() - postproc_start) * 1000
@@ -196,26 +310,133 @@ def generate_fake_frame(frame, avatar, generator, kp_detector, relative=False, a
     return preview_frame, out[..., ::-1], kp_driving_initial
 
 
-class Avatarify(FrameTransformer):
-    global kp_driving_initial
-    kp_driving_initial = None
+class AvatarifySession(FrameTransformerSession):
+    """
+    Per-call Avatarify state. Model weights are shared through the
+    `Avatarify` transformer, so one loaded model can serve several calls.
+    """
+
+    def __init__(self, transformer, avatar=None):
+        super().__init__(transformer)
+        self.avatar = transformer.avatar if avatar is None else avatar
+        self.kp_driving_initial = None
+        self.display_string = ""
+        self.buffers = transformer.create_buffers()
+        self.passthrough = False
+        self.output_flip = False
+
+    def transform(self, frame, frame_idx=None):
+        afy = self.transformer
+        if frame_idx % int(1. / afy.freq) != 0:
+            return
 
-    def __init__(self, freq=1. / 30, avatar=0):
+        try:
+            # Call avatarify models here
+            (preview_frame, fake_frame,
+             self.kp_driving_initial) = afy.generate_fake_frame(frame,
+                                                                afy.get_avatar(self.avatar),
+                                                                afy.generator,
+                                                                afy.kp_detector,
+                                                                afy.fa,
+                                                                kp_driving_initial=self.kp_driving_initial,
+                                                                verbose=True,
+                                                                device=afy.device,
+                                                                display_string=self.display_string,
+                                                                frame_proportion=afy.frame_proportion,
+                                                                prescaled=True,
+                                                                buffers=self.buffers,
+                                                                passthrough=self.passthrough,
+                                                                output_flip=self.output_flip,
+                                                                buffer=self.buffer,
+                                                                # the preview is not sent
+                                                                preview=False)
+            # fake_frame = self.cv2.resize(fake_frame, (0,0), fx=2., fy=2.)
+            return fake_frame
+        except FramePoolExhausted:
+            # the track drops the frame
+            raise
+        except Exception as err:
+            afy.traceback.print_exc()
+            return frame[..., ::-1]
+
+    def control(self, message):
+        # replaces the keyboard controls of the desktop Avatarify app
+        afy = self.transformer
+        kind = message.get('type')
+        if kind == 'avatar':
+            index = message.get('index', self.avatar + message.get('step', 1))
+            self.avatar = int(index) % len(afy.avatars)
+            self.kp_driving_initial = None
+        elif kind == 'passthrough':
+            self.passthrough = bool(message.get('value', not self.passthrough))
+        elif kind == 'flip':
+            self.output_flip = bool(message.get('value', not self.output_flip))
+        elif kind == 'reset':
+            # the next frame becomes the reference pose
+            self.kp_driving_initial = None
+        elif kind == 'frame_proportion':
+            # shared by the calls of this transformer, it sets the input scale
+            value = message.get('value', afy.frame_proportion + message.get('step', 0))
+            afy.frame_proportion = min(max(float(value), 0.1), 1.0)
+        else:
+            return {'type': 'error', 'message': f'Unknown control message: {kind}'}
+        return {'type': 'state', 'avatar': self.avatar, 'passthrough': self.passthrough,
+                'flip': self.output_flip, 'frame_proportion': afy.frame_proportion}
+
+
+# Browser keys for AvatarifySession.control, see ColabCall.join(control_keys=...)
+CONTROL_KEYS = {
+    'a': {'type': 'avatar', 'step': -1},
+    'd': {'type': 'avatar', 'step': 1},
+    'w': {'type': 'frame_proportion', 'step': -0.05},
+    's': {'type': 'frame_proportion', 'step': 0.05},
+    'x': {'type': 'reset'},
+    't': {'type': 'flip'},
+    '0': {'type': 'passthrough'},
+}
+
+
+class Avatarify(FrameTransformer):
+    # frames are scaled and converted to RGB by the video track, and the
+    # output is scaled back to the received frame size
+    input_format = 'rgb24'
+    output_size = 'source'
+
+    def __init__(self, freq=1. / 30, avatar=0, backend='eager', threads=None, quantize=False,
+                 export_dir='/content/avatarify/cpu'):
+        """
+        On CPU, `backend='torchscript'` runs exported, graph-optimized models
+        (see avatarify_cpu.py) with `threads` intra-op threads, optionally
+        quantized to int8.
+        """
         import torch
         self.config = '/content/avatarify/fomm/config/vox-adv-256.yaml'
         self.checkpoint = '/content/avatarify/vox-adv-cpk.pth.tar'
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.avatar = avatar
         self.freq = freq
+        self.backend = backend if self.device == 'cpu' else 'eager'
+        self.threads = threads
+        self.quantize = quantize
+        self.export_dir = export_dir
+        self.frame_proportion = 0.9
+        self._default_session = None
+
+    def input_size(self, width, height):
+        # scale so that the center crop used by the model is 256x256
+        scale = 256 / int(min(width, height) * self.frame_proportion)
+        return max(256, round(width * scale)), max(256, round(height * scale))
 
     def setup(self):
-        from avatarify_colab import load_checkpoints, generate_fake_frame, load_avatars
+        from avatarify_colab import (load_checkpoints, generate_fake_frame, load_avatars,
+                                     load_face_alignment, prepare_avatar)
         import traceback
         import cv2
 
         self.load_checkpoints = load_checkpoints
         self.generate_fake_frame = generate_fake_frame
         self.load_avatars = load_avatars
+        self.prepare_avatar = prepare_avatar
         self.traceback = traceback
         self.cv2 = cv2
         generator, kp_detector = load_checkpoints(config_path=self.config,
@@ -223,45 +444,59 @@ class Avatarify(FrameTransformer):
                                                   device=self.device)
         self.generator = generator
         self.kp_detector = kp_detector
+        # The landmark model is loaded once per session, not once per frame
+        self.fa = load_face_alignment(device=self.device)
         self.avatars = load_avatars()
+        self._avatar_states = {}
+
+        if self.backend == 'torchscript':
+            import avatarify_cpu
+            if not avatarify_cpu.is_exported(self.export_dir, quantize=self.quantize,
+                                             checkpoint=self.checkpoint):
+                # avatars are only decoded to calibrate the quantization
+                images = ([self.avatars[i] for i in range(len(self.avatars))]
+                          if self.quantize else ())
+                avatarify_cpu.export(generator, kp_detector, self.export_dir,
+                                     calibration_images=images, quantize=self.quantize,
+                                     checkpoint=self.checkpoint)
+            self.generator, self.kp_detector = avatarify_cpu.load(self.export_dir, self.threads)
 
         import numpy as np
         test_frame = np.zeros((200, 200, 3))
-        self.generate_fake_frame(test_frame, self.avatars[self.avatar],
-                                 self.generator, self.kp_detector,
-                                 kp_driving_initial=kp_driving_initial,
-                                 verbose=True)
-
-    def transform(self, frame, frame_idx=None, avatar=0):
-        if frame_idx % int(1. / self.freq) != 0:
-            return
-
-        try:
-            global display_string
-            display_string = ""
-            global kp_driving_initial
-
-            frame = self.cv2.resize(frame, (0, 0), fx=0.5, fy=0.5)
-            # Call avatarify models here
-            (preview_frame, fake_frame,
-             kp_driving_initial) = self.generate_fake_frame(frame,
-                                                            self.avatars[self.avatar],
-                                                            self.generator,
-                                                            self.kp_detector,
-                                                            kp_driving_initial=kp_driving_initial,
-                                                            verbose=True)
-            # fake_frame = self.cv2.resize(fake_frame, (0,0), fx=2., fy=2.)
-            return fake_frame
-        except Exception as err:
-            self.traceback.print_exc()
-            return frame
-
-
-def run(room=None, signaling_folder='/content/webrtc', avatar=0, frame_freq=1. / 30, verbose=False):
+        self.generate_fake_frame(test_frame, self.get_avatar(self.avatar),
+                                 self.generator, self.kp_detector, self.fa,
+                                 verbose=True, device=self.device)
+
+    def create_buffers(self):
+        if self.backend == 'torchscript':
+            from avatarify_cpu import PredictBuffers
+            return PredictBuffers(device=self.device)
+
+    def get_avatar(self, index):
+        """Return the cached state for an avatar, preparing it on first use."""
+        if index not in self._avatar_states:
+            self._avatar_states[index] = self.prepare_avatar(self.avatars[index], self.fa,
+                                                             self.kp_detector, device=self.device,
+                                                             avatar_kp=self.avatars.landmarks(index, self.fa))
+        return self._avatar_states[index]
+
+    def create_session(self, avatar=None):
+        return AvatarifySession(self, avatar=avatar)
+
+    def transform(self, frame, frame_idx=None):
+        # Used when called directly, outside of a VideoTransformTrack
+        if self._default_session is None:
+            self._default_session = self.create_session()
+        return self._default_session.transform(frame, frame_idx)
+
+
+def run(room=None, signaling_folder='/content/webrtc', avatar=0, frame_freq=1. / 30, verbose=False,
+        backend='eager', threads=None, quantize=False):
     if room:
         room = str(room)
 
-    afy = Avatarify(freq=frame_freq, avatar=avatar)
+    afy = Avatarify(freq=frame_freq, avatar=avatar, backend=backend, threads=threads,
+                    quantize=quantize)
     call = ColabCall()
     call.create(room, signaling_folder=signaling_folder, verbose=verbose,
                 frame_transformer=afy, multiprocess=False)
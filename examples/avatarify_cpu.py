@@ -0,0 +1,233 @@
+# CPU inference backend for the Avatarify example: the FOMM models are traced
+# to TorchScript, frozen and optimized for inference. The scripted models keep
+# the calling convention of the eager modules used by avatarify_colab.predict.
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import fire
+
+
+class _KPDetectorWrapper(torch.nn.Module):
+    def __init__(self, kp_detector):
+        super().__init__()
+        self.kp_detector = kp_detector
+
+    def forward(self, x):
+        kp = self.kp_detector(x)
+        return kp['value'], kp['jacobian']
+
+
+class _GeneratorWrapper(torch.nn.Module):
+    def __init__(self, generator):
+        super().__init__()
+        self.generator = generator
+
+    def forward(self, source, kp_driving_value, kp_driving_jacobian,
+                kp_source_value, kp_source_jacobian):
+        kp_driving = {'value': kp_driving_value, 'jacobian': kp_driving_jacobian}
+        kp_source = {'value': kp_source_value, 'jacobian': kp_source_jacobian}
+        return self.generator(source, kp_driving=kp_driving, kp_source=kp_source)['prediction']
+
+
+class ScriptedKPDetector:
+    def __init__(self, module):
+        self.module = module
+
+    def __call__(self, x):
+        value, jacobian = self.module(x)
+        return {'value': value, 'jacobian': jacobian}
+
+
+class ScriptedGenerator:
+    def __init__(self, module):
+        self.module = module
+
+    def __call__(self, source, kp_source, kp_driving):
+        prediction = self.module(source, kp_driving['value'], kp_driving['jacobian'],
+                                 kp_source['value'], kp_source['jacobian'])
+        return {'prediction': prediction}
+
+
+def set_threads(threads=None):
+    if threads:
+        torch.set_num_threads(threads)
+
+
+def quantize_static(module, example_inputs, calibration_inputs):
+    """
+    Post-training int8 quantization with FX graph mode. FOMM is mostly
+    convolutions, which dynamic quantization does not cover, so activations
+    are calibrated on `calibration_inputs`. Returns None if the module
+    cannot be symbolically traced.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    try:
+        prepared = prepare_fx(module, get_default_qconfig_mapping('x86'), example_inputs)
+        with torch.no_grad():
+            for inputs in calibration_inputs:
+                prepared(*inputs)
+        return convert_fx(prepared)
+    except Exception as err:
+        print(f'Could not quantize {type(module).__name__}, using float32: {err}')
+
+
+def _export_key(quantize, checkpoint):
+    # what the exported models were built from, see is_exported
+    key = {'quantize': bool(quantize), 'checkpoint': None, 'checkpoint_mtime': None}
+    if checkpoint:
+        key['checkpoint'] = os.path.abspath(checkpoint)
+        if os.path.exists(checkpoint):
+            key['checkpoint_mtime'] = os.path.getmtime(checkpoint)
+    return key
+
+
+def export(generator, kp_detector, output_dir, calibration_images=(), quantize=False,
+           checkpoint=None):
+    """
+    Trace the models to TorchScript and save them to `output_dir`. With
+    `quantize`, the models are quantized to int8 using `calibration_images`
+    (float32 arrays of shape 256x256x3 in [0, 1], e.g. avatars). The
+    quantize mode and the `checkpoint` the models were loaded from are saved
+    with them, for `is_exported`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    kp_module = _KPDetectorWrapper(kp_detector.cpu()).eval()
+    generator_module = _GeneratorWrapper(generator.cpu()).eval()
+
+    source = torch.rand(1, 3, 256, 256)
+    with torch.no_grad():
+        kp_value, kp_jacobian = kp_module(source)
+    kp_inputs = (source,)
+    generator_inputs = (source, kp_value, kp_jacobian, kp_value, kp_jacobian)
+
+    if quantize and len(calibration_images):
+        images = [torch.from_numpy(np.ascontiguousarray(img, dtype=np.float32))
+                  .permute(2, 0, 1)[None] for img in calibration_images]
+        with torch.no_grad():
+            kps = [kp_module(img) for img in images]
+        # identity motion: each image drives itself
+        quantized = quantize_static(kp_module, kp_inputs, [(img,) for img in images])
+        kp_module = quantized if quantized is not None else kp_module
+        quantized = quantize_static(generator_module, generator_inputs,
+                                    [(img, v, j, v, j) for img, (v, j) in zip(images, kps)])
+        generator_module = quantized if quantized is not None else generator_module
+
+    with torch.no_grad():
+        kp_script = torch.jit.freeze(torch.jit.trace(kp_module, kp_inputs, check_trace=False))
+        generator_script = torch.jit.freeze(torch.jit.trace(generator_module, generator_inputs,
+                                                            check_trace=False))
+    torch.jit.save(kp_script, os.path.join(output_dir, 'kp_detector.pt'))
+    torch.jit.save(generator_script, os.path.join(output_dir, 'generator.pt'))
+    # written last, so an interrupted export is not used
+    with open(os.path.join(output_dir, 'export.json'), 'w') as f:
+        json.dump(_export_key(quantize, checkpoint), f)
+
+
+def load(output_dir, threads=None):
+    """Load exported models, returning (generator, kp_detector) callables."""
+    set_threads(threads)
+    kp_script = torch.jit.load(os.path.join(output_dir, 'kp_detector.pt'), map_location='cpu')
+    generator_script = torch.jit.load(os.path.join(output_dir, 'generator.pt'), map_location='cpu')
+    kp_script = torch.jit.optimize_for_inference(kp_script)
+    generator_script = torch.jit.optimize_for_inference(generator_script)
+    return ScriptedGenerator(generator_script), ScriptedKPDetector(kp_script)
+
+
+def is_exported(output_dir, quantize=False, checkpoint=None):
+    """
+    Whether `output_dir` has models exported from `checkpoint` (as it is
+    now) with the same `quantize` mode.
+    """
+    if not all(os.path.exists(os.path.join(output_dir, f))
+               for f in ['kp_detector.pt', 'generator.pt']):
+        return False
+    try:
+        with open(os.path.join(output_dir, 'export.json')) as f:
+            return json.load(f) == _export_key(quantize, checkpoint)
+    except (OSError, ValueError):
+        return False
+
+
+class PredictBuffers:
+    """
+    Input and output buffers reused across `predict` calls, so per-frame
+    inference does not allocate the driving tensor or the output image.
+    """
+
+    def __init__(self, size=256, device='cpu'):
+        self.driving = torch.empty(1, 3, size, size, dtype=torch.float32, device=device)
+        self.out = np.empty((size, size, 3), dtype=np.uint8)
+        self._out_float = np.empty((size, size, 3), dtype=np.float32)
+
+    def set_driving(self, frame):
+        self.driving.copy_(torch.from_numpy(np.ascontiguousarray(frame, dtype=np.float32))
+                           .permute(2, 0, 1)[None])
+        return self.driving
+
+    def set_output(self, prediction):
+        np.copyto(self._out_float, prediction[0].permute(1, 2, 0).cpu().numpy())
+        np.clip(self._out_float, 0, 1, out=self._out_float)
+        np.multiply(self._out_float, 255, out=self._out_float)
+        np.copyto(self.out, self._out_float, casting='unsafe')
+        return self.out
+
+
+def benchmark(frames=50, threads=None, quantize=False, export_dir=None,
+              config='/content/avatarify/fomm/config/vox-adv-256.yaml',
+              checkpoint='/content/avatarify/vox-adv-cpk.pth.tar',
+              avatars_dir='./avatarify/avatars'):
+    """
+    Compare the TorchScript backend with eager PyTorch, frame for frame,
+    using the avatars as source and driving images. The models are exported
+    to `export_dir`, or by default to a temporary folder, so the models of
+    a running peer are left alone.
+    """
+    from avatarify_colab import load_checkpoints, load_avatars, predict
+
+    set_threads(threads)
+    generator, kp_detector = load_checkpoints(config_path=config, checkpoint_path=checkpoint,
+                                              device='cpu')
+    avatars = load_avatars(avatars_dir)
+    images = [avatars[i] for i in range(len(avatars))]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        export_dir = export_dir or tmp_dir
+        if not is_exported(export_dir, quantize=quantize, checkpoint=checkpoint):
+            export(generator, kp_detector, export_dir, calibration_images=images, quantize=quantize,
+                   checkpoint=checkpoint)
+        backends = {'eager': (generator, kp_detector), 'torchscript': load(export_dir, threads)}
+
+    source = images[0]
+    driving_frames = [images[i % len(images)] for i in range(frames)]
+    outputs = {}
+    for name, (gen, kp) in backends.items():
+        with torch.no_grad():
+            source_tensor = torch.from_numpy(source).permute(2, 0, 1)[None]
+            avatar_state = {'source': source_tensor, 'kp_source': kp(source_tensor)}
+        buffers = PredictBuffers()
+        kp_driving_initial = None
+        latencies = []
+        outputs[name] = []
+        for frame in driving_frames:
+            start = time.perf_counter()
+            out, kp_driving_initial = predict(frame, avatar_state, False, True, gen, kp,
+                                              kp_driving_initial, device='cpu', buffers=buffers)
+            latencies.append(time.perf_counter() - start)
+            outputs[name].append(out.copy())
+        latencies = np.array(latencies[1:]) * 1000
+        print(f'{name}: {latencies.mean():.1f}ms mean, {np.percentile(latencies, 95):.1f}ms p95')
+
+    diffs = [np.abs(a.astype(np.int16) - b.astype(np.int16))
+             for a, b in zip(outputs['eager'], outputs['torchscript'])]
+    mse = np.mean([np.mean(d.astype(np.float64) ** 2) for d in diffs])
+    psnr = 10 * np.log10(255 ** 2 / mse) if mse > 0 else float('inf')
+    print(f'max abs diff: {max(d.max() for d in diffs)}, PSNR: {psnr:.1f}dB')
+
+
+if __name__ == '__main__':
+    fire.Fire(benchmark)
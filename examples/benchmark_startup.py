@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import time
+
+import fire
+
+COLABRTC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'colabrtc')
+
+# Modules that should only be loaded by the features that need them
+HEAVY_MODULES = ['cv2', 'fire', 'aiohttp', 'websockets', 'IPython', 'google.colab',
+                 'aiortc.contrib.media', 'aiortc.contrib.signaling']
+
+SCRIPT = '''
+import sys, time
+sys.path.insert(0, {folder!r})
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = [m for m in {heavy!r} if m in sys.modules]
+print(elapsed, ','.join(loaded))
+'''
+
+
+def measure(module='peer', repeat=5):
+    """Import `module` in fresh interpreters, as a peer process or the CLI would."""
+    script = SCRIPT.format(folder=COLABRTC_FOLDER, module=module, heavy=HEAVY_MODULES)
+    import_times = []
+    process_times = []
+    loaded = ''
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', script], check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        process_times.append(time.perf_counter() - start)
+        import_time, _, loaded = result.stdout.strip().partition(' ')
+        import_times.append(float(import_time))
+
+    return min(import_times), min(process_times), loaded
+
+
+def run(modules=('signaling', 'peer'), repeat=5):
+    for module in modules:
+        import_time, process_time, loaded = measure(module, repeat=repeat)
+        print(f'{module}: import {import_time * 1000:.1f}ms, '
+              f'process {process_time * 1000:.1f}ms, '
+              f'heavy modules loaded: {loaded or "none"}')
+
+
+if __name__ == '__main__':
+    fire.Fire(run)
@@ -0,0 +1,47 @@
+import os
+import sys
+import types
+
+import pytest
+
+# the modules of colabrtc import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'colabrtc'))
+
+
+class FakeColabOutput(types.ModuleType):
+    """
+    Stands in for `google.colab.output`: callbacks registered by Python are
+    called by `invoke_function`, as `google.colab.kernel.invokeFunction`
+    would from the page, and the result is returned as the page sees it.
+    """
+
+    def __init__(self):
+        super().__init__('google.colab.output')
+        self.callbacks = {}
+
+    def register_callback(self, name, callback):
+        self.callbacks[name] = callback
+
+    def invoke_function(self, name, args=()):
+        result = self.callbacks[name](*args)
+        data = {}
+        if result is not None:
+            # IPython.display.JSON
+            data['application/json'] = getattr(result, 'data', result)
+        return {'data': data}
+
+
+@pytest.fixture
+def colab(monkeypatch):
+    import signaling
+
+    output = FakeColabOutput()
+    google = types.ModuleType('google')
+    colab = types.ModuleType('google.colab')
+    google.colab = colab
+    colab.output = output
+    monkeypatch.setitem(sys.modules, 'google', google)
+    monkeypatch.setitem(sys.modules, 'google.colab', colab)
+    monkeypatch.setitem(sys.modules, 'google.colab.output', output)
+    monkeypatch.setattr(signaling, '_output', None)
+    return output
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from buffers import FramePool, FramePoolExhausted
+
+
+def test_buffer_is_reused_once_released():
+    pool = FramePool()
+    frame = pool.get((4, 4, 3))
+    address = frame.ctypes.data
+    # e.g. a flipped output kept as the last frame
+    view = frame[::-1]
+    del frame
+
+    other = pool.get((4, 4, 3))
+    assert other.ctypes.data != address
+    assert pool.allocations == 2
+
+    del view
+    again = pool.get((4, 4, 3))
+    assert again.ctypes.data == address
+    assert (pool.allocations, pool.reuses) == (2, 1)
+
+
+def test_pool_raises_when_exhausted():
+    pool = FramePool(max_bytes=2 * 4 * 4 * 3)
+    frames = [pool.get((4, 4, 3)), pool.get((4, 4, 3))]
+    with pytest.raises(FramePoolExhausted):
+        pool.get((4, 4, 3))
+    assert pool.memory == 2 * frames[0].nbytes
+
+    # free buffers of another shape are evicted to make room
+    del frames
+    small = pool.get((2, 2), dtype=np.float32)
+    assert small.dtype == np.float32
+    assert pool.memory == small.nbytes
@@ -0,0 +1,52 @@
+import asyncio
+import fractions
+
+from av import VideoFrame
+from aiortc.mediastreams import MediaStreamTrack
+
+from peer import VideoTransformTrack
+
+
+class CountingTrack(MediaStreamTrack):
+    """Video frames at 30fps, with timestamps starting at `start` seconds."""
+
+    kind = 'video'
+
+    def __init__(self, start):
+        super().__init__()
+        self.pts = int(start * 90000)
+        self.frames = 0
+
+    async def recv(self):
+        await asyncio.sleep(0)
+        frame = VideoFrame(width=64, height=48)
+        frame.pts = self.pts
+        frame.time_base = fractions.Fraction(1, 90000)
+        self.pts += 3000
+        self.frames += 1
+        return frame
+
+
+def test_frames_flow_after_source_is_replaced():
+    async def call():
+        track = VideoTransformTrack(CountingTrack(start=1000.), None)
+        track.max_fps = 15
+        for _ in range(5):
+            await track.recv()
+
+        # a reconnect: the new source starts at lower timestamps
+        track.track = None
+        await track.recv()
+        source = CountingTrack(start=10.)
+        track.track = source
+        for _ in range(5):
+            frame = await asyncio.wait_for(track.recv(), 1)
+            assert frame.width == 64
+        # every other frame is dropped at 15fps
+        assert source.frames <= 10
+
+        # timestamps going back on the same source restart the limiter
+        source.pts = 0
+        await asyncio.wait_for(track.recv(), 1)
+
+    asyncio.run(call())
@@ -0,0 +1,36 @@
+import json
+import threading
+
+from server import FilesystemRTCServer
+
+
+def join(server, room):
+    return server.join(room)['params']['peer_id']
+
+
+def test_join_does_not_redeliver_claimed_messages(tmp_path):
+    server = FilesystemRTCServer(folder=str(tmp_path))
+    for attempt in range(20):
+        room = f'{attempt:010d}'
+        sender, receiver = join(server, room), join(server, room)
+        sent = [json.dumps({'type': 'candidate', 'candidate': f'candidate:{i}', 'sdpMid': '0',
+                            'sdpMLineIndex': 0}) for i in range(30)]
+        for message in sent:
+            server.send_message(room, sender, message)
+
+        # a third peer joins while the receiver claims the messages
+        received = []
+        joined = []
+        joiner = threading.Thread(target=lambda: joined.append(join(server, room)))
+        joiner.start()
+        while joiner.is_alive() or len(received) < len(sent):
+            received.extend(server.receive_messages(room, receiver))
+        joiner.join()
+        received.extend(server.receive_messages(room, receiver))
+        assert sorted(received) == sorted(sent)
+
+        late = server.receive_messages(room, joined[0])
+        assert len(late) == len(set(late))
+        # the new peer only gets messages nobody had claimed when it joined
+        assert set(late) <= set(sent)
+        assert server.receive_messages(room, receiver) == []
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import time
+
+import pytest
+from aiortc import RTCSessionDescription
+
+from signaling import BYE, ColabSignaling
+
+ROOM = '0123456789'
+JS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'colabrtc', 'js')
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def callback(action):
+    return f'{ROOM}.colab.signaling.{action}'
+
+
+def test_exchange(colab, loop, tmp_path):
+    js = ColabSignaling(signaling_folder=str(tmp_path), room=ROOM, javacript_callable=True)
+    py = ColabSignaling(signaling_folder=str(tmp_path), room=ROOM)
+    assert colab.invoke_function(callback('connect'))['data']['application/json']['is_initiator'] is True
+    loop.run_until_complete(py.connect())
+
+    offer = {'type': 'offer', 'sdp': 'v=0\r\n'}
+    colab.invoke_function(callback('send'), [json.dumps(offer)])
+    messages = loop.run_until_complete(py.receive_batch(timeout=0))
+    assert [(m.type, m.sdp) for m in messages] == [('offer', 'v=0\r\n')]
+
+    loop.run_until_complete(py.send(RTCSessionDescription(sdp='v=0\r\n', type='answer')))
+    loop.run_until_complete(py.send(BYE))
+    result = colab.invoke_function(callback('receive_batch'), [0])
+    assert [m['type'] for m in result['data']['application/json']] == ['answer', 'bye']
+    assert colab.invoke_function(callback('receive_batch'), [0])['data']['application/json'] == []
+
+
+def test_javascript_receive_does_not_wait(colab, loop, tmp_path):
+    ColabSignaling(signaling_folder=str(tmp_path), room=ROOM, javacript_callable=True)
+    colab.invoke_function(callback('connect'))
+
+    start = time.monotonic()
+    for _ in range(10):
+        colab.invoke_function(callback('receive_batch'), [0])
+    # the kernel is free for the sends of the page between polls
+    assert time.monotonic() - start < .2
+
+
+def test_missing_room_folder(colab, loop, tmp_path):
+    folder = tmp_path / 'webrtc'
+    js = ColabSignaling(signaling_folder=str(folder), room=ROOM, javacript_callable=True)
+    py = ColabSignaling(signaling_folder=str(folder), room=ROOM)
+    colab.invoke_function(callback('connect'))
+    loop.run_until_complete(py.connect())
+    shutil.rmtree(folder / f'room_{ROOM}')
+
+    assert colab.invoke_function(callback('receive_batch'), [0])['data']['application/json'] == []
+    assert colab.invoke_function(callback('receive'))['data'] == {}
+    assert loop.run_until_complete(py.receive_batch(timeout=0)) == []
+    assert loop.run_until_complete(py.receive()) is None
+
+
+# Runs js/signaling.js in node, with google.colab.kernel.invokeFunction
+# forwarded to the fake kernel of the test over stdin and stdout
+NODE_PAGE = """
+const fs = require('fs');
+const vm = require('vm');
+const readline = require('readline');
+
+const lines = readline.createInterface({input: process.stdin});
+const replies = [];
+lines.on('line', line => replies.shift()(JSON.parse(line)));
+const write = data => process.stdout.write(JSON.stringify(data) + '\\n');
+console.log = () => {};
+
+globalThis.google = {colab: {kernel: {invokeFunction: (name, args, kwargs) =>
+  new Promise(resolve => { replies.push(resolve); write({name: name, args: args}); })}}};
+vm.runInThisContext(fs.readFileSync(process.argv[2], 'utf8'));
+
+(async () => {
+  const channel = new SignalingChannel(process.argv[3]);
+  const received = [];
+  channel.onmessage = message => received.push(message);
+  await channel.connect();
+  await channel.send({type: 'offer', sdp: 'v=0'});
+  while (!received.length) {
+    const messages = await channel.receive();
+    if (!messages.length) {
+      await channel.wait();
+    }
+  }
+  await channel.close();
+  write({received: received});
+  lines.close();
+})();
+"""
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='node is not installed')
+def test_javascript_page(colab, loop, tmp_path):
+    ColabSignaling(signaling_folder=str(tmp_path), room=ROOM, javacript_callable=True)
+    py = ColabSignaling(signaling_folder=str(tmp_path), room=ROOM)
+    page = tmp_path / 'page.js'
+    page.write_text(NODE_PAGE)
+    node = subprocess.Popen(['node', str(page), os.path.join(JS_DIR, 'signaling.js'), ROOM],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    calls = []
+    try:
+        for line in node.stdout:
+            call = json.loads(line)
+            if 'received' in call:
+                break
+            calls.append(call['name'].rsplit('.', 1)[-1])
+            if calls[-1] == 'connect':
+                loop.run_until_complete(py.connect())
+            node.stdin.write(json.dumps(colab.invoke_function(call['name'], call['args'])) + '\n')
+            node.stdin.flush()
+
+            # the Python peer answers after a few polls of the page
+            if calls.count('receive_batch') == 3:
+                offer, = loop.run_until_complete(py.receive_batch(timeout=0))
+                assert offer.type == 'offer'
+                loop.run_until_complete(py.send(RTCSessionDescription(sdp='v=0', type='answer')))
+    finally:
+        node.stdin.close()
+        node.wait(timeout=10)
+
+    assert call['received'] == [{'sdp': 'v=0', 'type': 'answer'}]
+    assert calls[:2] == ['connect', 'send']
+    assert calls[-1] == 'close'
+    assert calls.count('receive_batch') == 4
+    assert loop.run_until_complete(py.receive()) is BYE
@@ -0,0 +1,41 @@
+import asyncio
+
+from stats import RingBufferSink, StatsCollector
+
+
+class FakePeerConnection:
+    signalingState = 'stable'
+
+    async def getStats(self):
+        return {}
+
+
+class ClosingSink(RingBufferSink):
+    closed = 0
+
+    def write(self, sample):
+        assert not self.closed
+        super().write(sample)
+
+    def close(self):
+        self.closed += 1
+
+
+def test_sinks_outlive_replaced_connections():
+    sink = ClosingSink()
+
+    async def call():
+        # a connection replaced by another, writing to the same sinks
+        first = StatsCollector(FakePeerConnection(), [sink], interval=.01).start()
+        await asyncio.sleep(.05)
+        first.stop()
+        second = StatsCollector(FakePeerConnection(), [sink], interval=.01).start()
+        await asyncio.sleep(.05)
+        assert not sink.closed
+        written = len(sink.samples)
+        await asyncio.sleep(.05)
+        assert len(sink.samples) > written
+        second.close()
+
+    asyncio.run(call())
+    assert sink.closed == 1